@@ -1,10 +1,105 @@
-from flask import Flask
+import os
+from flask import Flask, jsonify, request
+from eig_state.asgi import ASGIService
+from eig_state.cache import HistoryCache
+from eig_state.codec import Codec
+from eig_state.metrics import CONTENT_TYPE, registry
+from eig_state.service import ENDPOINTS, ManagerPool, handle
+from eig_state.sharding import ShardedManagerPool
+from eig_state.write_behind import WriteBehindQueue
 
-app = Flask("eig_state_manager")
 
-@app.route('/')
-def hello():
-    return 'Hello world'
+def settings():
+    """
+    ManagerPool arguments from the environment: EIG_STATE_MAX_MANAGERS,
+    EIG_STATE_TURN_TIMEOUT, EIG_STATE_WINDOW, EIG_STATE_COMPACT and
+    EIG_STATE_WRITE_BEHIND (set to 1 to save histories from a background
+    queue). EIG_STATE_CACHE_TTL is how long, in seconds, histories are
+    cached. EIG_STATE_CODEC=1 stores states packed by a Codec.
+    EIG_STATE_METRICS=1 turns on the metrics served at /metrics. Sessions
+    are sharded when EIG_STATE_NODE names this worker among the
+    comma separated EIG_STATE_NODES, by EIG_STATE_AFFINITY (userid or
+    sessionid).
+    """
+    kwargs = {}
+    if 'EIG_STATE_NODE' in os.environ:
+        kwargs['node'] = os.environ['EIG_STATE_NODE']
+        kwargs['nodes'] = os.environ.get('EIG_STATE_NODES',
+                                         kwargs['node']).split(',')
+        kwargs['affinity'] = os.environ.get('EIG_STATE_AFFINITY', 'userid')
+    if 'EIG_STATE_MAX_MANAGERS' in os.environ:
+        kwargs['max_managers'] = int(os.environ['EIG_STATE_MAX_MANAGERS'])
+    if 'EIG_STATE_TURN_TIMEOUT' in os.environ:
+        kwargs['turn_timeout'] = float(os.environ['EIG_STATE_TURN_TIMEOUT'])
+    if 'EIG_STATE_WINDOW' in os.environ:
+        kwargs['window'] = int(os.environ['EIG_STATE_WINDOW'])
+    if 'EIG_STATE_CACHE_TTL' in os.environ:
+        kwargs['cache'] = HistoryCache(
+            ttl=float(os.environ['EIG_STATE_CACHE_TTL']))
+    if os.environ.get('EIG_STATE_COMPACT') == '1':
+        kwargs['compact'] = True
+    if os.environ.get('EIG_STATE_CODEC') == '1':
+        kwargs['codec'] = Codec()
+    if os.environ.get('EIG_STATE_WRITE_BEHIND') == '1':
+        kwargs['write_behind'] = WriteBehindQueue()
+    if os.environ.get('EIG_STATE_METRICS') == '1':
+        registry.enabled = True
+    return kwargs
+
+
+def create_pool(**kwargs):
+    """
+    A ShardedManagerPool if kwargs name a node, or else a ManagerPool
+    """
+    if 'node' in kwargs:
+        return ShardedManagerPool(**kwargs)
+    return ManagerPool(**kwargs)
+
+
+def create_app(pool=None, **manager_kwargs):
+    """
+    The state service as a WSGI app (see eig_state.service.handle for its
+    endpoints), e.g. gunicorn -c gunicorn.conf.py 'app:create_app()'.
+    Requests share pool, a ManagerPool made with manager_kwargs (or the
+    environment's settings) unless one is given.
+    """
+    app = Flask("eig_state_manager")
+    if pool is None:
+        pool = create_pool(**(manager_kwargs or settings()))
+    app.config['MANAGER_POOL'] = pool
+
+    def view():
+        body = None
+        if request.method == 'POST':
+            body = request.get_json(force=True, silent=True)
+        status, payload = handle(pool, request.method, request.path, body)
+        if isinstance(payload, str):
+            return payload, status, {'Content-Type': CONTENT_TYPE}
+        return jsonify(payload), status
+
+    for path in ENDPOINTS:
+        app.add_url_rule(path, path, view, methods=['GET', 'POST'])
+    return app
+
+
+def create_asgi_app(pool=None, concurrency=None, drain_timeout=None,
+                    **manager_kwargs):
+    """
+    The state service as an ASGI app, e.g.
+    uvicorn --factory app:create_asgi_app, or gunicorn with
+    EIG_STATE_WORKER_CLASS=uvicorn.workers.UvicornWorker. concurrency
+    (EIG_STATE_CONCURRENCY) bounds the turns served at once and pending
+    writes are drained for up to drain_timeout (EIG_STATE_DRAIN_TIMEOUT)
+    seconds on shutdown.
+    """
+    if pool is None:
+        pool = create_pool(**(manager_kwargs or settings()))
+    if concurrency is None and 'EIG_STATE_CONCURRENCY' in os.environ:
+        concurrency = int(os.environ['EIG_STATE_CONCURRENCY'])
+    if drain_timeout is None:
+        drain_timeout = float(os.environ.get('EIG_STATE_DRAIN_TIMEOUT', 30))
+    return ASGIService(pool, concurrency, drain_timeout)
+
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', debug=True, port=8080)
+    create_app().run(host='0.0.0.0', debug=True, port=8080)
@@ -0,0 +1,107 @@
+import asyncio
+import functools
+from eig_state import history
+from eig_state import state
+from eig_state.core import dynamo_call
+from eig_state.metrics import registry
+from eig_state.state_manager import StateManager
+
+
+class AsyncTable:
+    """
+    Awaitable view of a table. Calls run on an executor (the loop's default
+    one if None) so the event loop isn't blocked while dynamodb answers.
+    """
+
+    def __init__(self, table, executor=None):
+        self.table = table
+        self.executor = executor
+
+    async def call(self, method, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self.executor,
+            functools.partial(dynamo_call, getattr(self.table, method), **kwargs))
+
+    async def get_item(self, **kwargs):
+        return await self.call('get_item', **kwargs)
+
+    async def put_item(self, **kwargs):
+        return await self.call('put_item', **kwargs)
+
+
+class AsyncStateManager(StateManager):
+    """
+    asyncio flavour of StateManager. Build it with
+
+        sm = await AsyncStateManager.create(userid, convid, sessionid)
+
+    which loads the conv and user histories, and then their state lists,
+    concurrently. next_round and set_response are awaitable and run the
+    extractors and saves on executor, so one event loop can serve many
+    conversations at once.
+    """
+
+    def __init__(self, userid, convid, sessionid, executor=None, **kwargs):
+        self.executor = executor
+        super().__init__(userid, convid, sessionid, **kwargs)
+
+    @classmethod
+    async def create(cls, userid, convid, sessionid, **kwargs):
+        sm = cls(userid, convid, sessionid, **kwargs)
+        await sm.load_async(userid, convid, sessionid)
+        return sm
+
+    def load(self, userid, convid, sessionid):
+        # histories are loaded by create()
+        self.conv_history = None
+        self.user_history = None
+
+    async def load_async(self, userid, convid, sessionid):
+        self.conv_history, self.user_history = await asyncio.gather(
+            self.get_history_async(sessionid, self.conv_tbl_name,
+                                   history.ConvHistory, self.conv_state_cls,
+                                   convid, userid),
+            self.get_history_async(userid, self.user_tbl_name,
+                                   history.UserHistory, self.user_state_cls))
+
+    def get_async_table(self, tbl_name):
+        return AsyncTable(self.get_table(tbl_name), self.executor)
+
+    async def run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor,
+                                          functools.partial(func, *args))
+
+    async def get_history_async(self, hist_id, tbl_name, cls, state_cls, *args):
+        hist = self.get_cached_history(tbl_name, hist_id)
+        if hist is not None:
+            return hist
+        with registry.span('eig_state_history_load_seconds', table=tbl_name):
+            response = await self.get_async_table(tbl_name).get_item(
+                Key={'id': hist_id})
+            item = response.get('Item')
+            state_list = None
+            if item:
+                response = await self.get_async_table(
+                    self.state_tbl_name).get_item(
+                        Key={'id': item['state_list_id']})
+                if 'Item' not in response:
+                    raise ValueError("State id doesn't exist in dynamodb states table")
+                state_list = state.StateList.from_dict(
+                    response['Item'], self.get_table(self.state_tbl_name),
+                    state_cls)
+                if self.window:
+                    await self.run(state_list.prefetch_last, self.window)
+            hist = self.build_history(hist_id, item, state_list, cls,
+                                      state_cls, *args)
+        if not item:
+            await self.run(self.save_history, tbl_name, hist)
+        self.cache_history(tbl_name, hist)
+        return hist
+
+    async def next_round(self, question):
+        return await self.run(super().next_round, question)
+
+    async def set_response(self, response):
+        return await self.run(super().set_response, response)
@@ -0,0 +1,104 @@
+import asyncio
+import concurrent.futures
+import json
+import time
+from eig_state.metrics import CONTENT_TYPE
+from eig_state.service import handle
+
+
+class ASGIService:
+    """
+    The state service (see eig_state.service.handle) as an ASGI application,
+    for uvicorn, hypercorn or gunicorn's uvicorn workers.
+
+    Turns run on a pool of concurrency threads, so the event loop keeps
+    taking requests while dynamodb answers. On lifespan shutdown, or
+    shutdown(), new requests are turned away with 503, the ones in flight
+    are finished and the pool's pending writes are drained, waiting at most
+    drain_timeout seconds in all.
+    """
+
+    def __init__(self, pool, concurrency=None, drain_timeout=30):
+        self.pool = pool
+        self.drain_timeout = drain_timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(
+            concurrency, thread_name_prefix='eig_state_service')
+        self.active = 0
+        self.closing = False
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                drained = await self.shutdown()
+                if drained:
+                    await send({'type': 'lifespan.shutdown.complete'})
+                else:
+                    await send({'type': 'lifespan.shutdown.failed',
+                                'message': "Pending writes weren't drained"})
+                return
+
+    async def http(self, scope, receive, send):
+        chunks = []
+        more = True
+        while more:
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+            chunks.append(message.get('body', b''))
+            more = message.get('more_body', False)
+        if self.closing:
+            await self.respond(send, 503, {'error': "Shutting down"})
+            return
+        body = None
+        if chunks[0] or len(chunks) > 1:
+            try:
+                body = json.loads(b''.join(chunks).decode('utf-8'))
+            except ValueError:
+                await self.respond(send, 400, {'error': "Invalid JSON"})
+                return
+        self.active += 1
+        try:
+            loop = asyncio.get_running_loop()
+            status, payload = await loop.run_in_executor(
+                self.executor, handle, self.pool, scope['method'],
+                scope['path'], body)
+        finally:
+            self.active -= 1
+        await self.respond(send, status, payload)
+
+    async def respond(self, send, status, payload):
+        content_type = 'application/json'
+        if isinstance(payload, str):
+            body = payload.encode('utf-8')
+            content_type = CONTENT_TYPE
+        else:
+            body = json.dumps(payload).encode('utf-8')
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(b'content-type', content_type.encode()),
+                                (b'content-length', str(len(body)).encode())]})
+        await send({'type': 'http.response.body', 'body': body})
+
+    async def shutdown(self):
+        """
+        Stops taking requests, waits for the ones in flight and drains the
+        pool's pending writes. Returns whether that was all done within
+        drain_timeout seconds.
+        """
+        self.closing = True
+        deadline = time.monotonic() + self.drain_timeout
+        while self.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        loop = asyncio.get_running_loop()
+        drained = await loop.run_in_executor(
+            None, self.pool.close, max(0, deadline - time.monotonic()))
+        self.executor.shutdown(wait=False)
+        return drained and not self.active
@@ -0,0 +1,118 @@
+import collections
+import threading
+import time
+from eig_state.core import item_size
+
+
+def history_size(history):
+    """
+    Estimates the bytes a history holds in memory from the size of its items
+    and those of the states and chunks it has loaded
+    """
+    size = item_size(history.id) + item_size(history.state_list_id or '')
+    state_list = history._state_list
+    if state_list is not None:
+        size += item_size(state_list.chunk_lengths)
+        size += sum(item_size(runs) for runs in state_list._chunks.values())
+        for state in state_list.states.values():
+            size += sum(item_size(getattr(state, var, None))
+                        for var, saver in state.savers.items() if not saver)
+    return size
+
+
+class HistoryCache:
+    """
+    Bounded in-process cache of loaded histories keyed by table name and id,
+    so the next turn of a conversation handled by the same worker doesn't
+    reload it from dynamodb.
+
+    The least recently used entries are evicted once there are more than
+    max_entries, or their estimated sizes add up to more than max_bytes, and
+    entries expire ttl seconds after they were stored (never if ttl is
+    None), so histories other processes save are picked up.
+
+    A cached history is the live object, shared by whoever gets it: a user's
+    history by the managers of all their sessions. Whoever holds a cached
+    history only changes or saves it while holding its lock, as StateManager
+    does for each next_round and set_response. A saved history replaces the
+    entry, dropping any older copy of it, and one that failed to save is
+    invalidated so it is reloaded.
+    """
+
+    def __init__(self, max_entries=1024, max_bytes=None, ttl=60):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tbl_name, hist_id):
+        key = (tbl_name, hist_id)
+        with self._lock:
+            entry = self._entries.get(key)
+            if (entry is not None and self.ttl is not None and
+                    time.monotonic() - entry[2] > self.ttl):
+                self._remove(key)
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, tbl_name, history):
+        """
+        Stores history, or refreshes its size and age if it is cached already
+        """
+        key = (tbl_name, history.id)
+        size = history_size(history)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (history, size, time.monotonic())
+            self.nbytes += size
+            while self._entries and (
+                    len(self._entries) > self.max_entries or
+                    (self.max_bytes is not None and
+                     self.nbytes > self.max_bytes)):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, tbl_name, hist_id):
+        with self._lock:
+            self._remove((tbl_name, hist_id))
+
+    def invalidate_if(self, predicate):
+        """
+        Drops the histories for which predicate(tbl_name, history) is true
+        and returns how many there were
+        """
+        with self._lock:
+            keys = [key for key, entry in self._entries.items()
+                    if predicate(key[0], entry[0])]
+            for key in keys:
+                self._remove(key)
+        return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= entry[1]
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'bytes': self.nbytes,
+                    'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
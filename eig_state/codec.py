@@ -0,0 +1,116 @@
+import decimal
+import json
+import zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+MAGIC = b'E'
+FORMAT_VERSION = 1
+SERIALIZERS = ['json', 'msgpack']
+COMPRESSIONS = [None, 'zlib', 'zstd']
+# attributes that stay outside the blob: the key, and the version conditions
+# are checked against
+KEPT = ('id', 'version')
+
+
+def _plain(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    raise TypeError("Can't pack {!r}".format(value))
+
+
+class Codec:
+    """
+    Packs the attributes of an item, apart from its id and version, into a
+    single binary 'blob' attribute, which is much smaller than the attribute
+    map dynamodb would otherwise store.
+
+    A blob starts with a header naming the format version, serializer and
+    compression it was written with, so items are read back whatever codec
+    wrote them (see unpack). serializer is 'json' or 'msgpack' (the default
+    if it is installed); compression is None, 'zlib' or 'zstd' and is only
+    applied to payloads of at least min_size bytes.
+    """
+
+    def __init__(self, serializer=None, compression='zlib', level=6,
+                 min_size=256):
+        if serializer is None:
+            serializer = 'msgpack' if msgpack is not None else 'json'
+        if serializer not in SERIALIZERS:
+            raise ValueError("Unknown serializer {!r}".format(serializer))
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unknown compression {!r}".format(compression))
+        if serializer == 'msgpack' and msgpack is None:
+            raise ImportError("The msgpack serializer needs msgpack installed")
+        if compression == 'zstd' and zstandard is None:
+            raise ImportError("zstd compression needs zstandard installed")
+        self.serializer = serializer
+        self.compression = compression
+        self.level = level
+        self.min_size = min_size
+
+    def pack(self, item):
+        fields = {key: value for key, value in item.items() if key not in KEPT}
+        if self.serializer == 'msgpack':
+            payload = msgpack.packb(fields, default=_plain, use_bin_type=True)
+        else:
+            payload = json.dumps(fields, default=_plain,
+                                 separators=(',', ':')).encode('utf-8')
+        compression = self.compression
+        if compression is None or len(payload) < self.min_size:
+            compression = None
+        elif compression == 'zlib':
+            payload = zlib.compress(payload, self.level)
+        else:
+            payload = zstandard.ZstdCompressor(level=self.level).compress(payload)
+        header = MAGIC + bytes([FORMAT_VERSION,
+                                SERIALIZERS.index(self.serializer) |
+                                COMPRESSIONS.index(compression) << 4])
+        packed = {key: item[key] for key in KEPT if key in item}
+        packed['blob'] = header + payload
+        return packed
+
+
+def unpack(item):
+    """
+    Returns item with the attributes in its blob, if it has one, restored
+    """
+    if 'blob' not in item:
+        return item
+    blob = item['blob']
+    blob = bytes(getattr(blob, 'value', blob))
+    if blob[:1] != MAGIC or len(blob) < 3:
+        raise ValueError("Item {} has a malformed blob".format(item.get('id')))
+    if blob[1] != FORMAT_VERSION:
+        raise ValueError("Item {} was packed in unknown format version {}"
+                         .format(item.get('id'), blob[1]))
+    serializer = SERIALIZERS[blob[2] & 0xf]
+    compression = COMPRESSIONS[blob[2] >> 4]
+    payload = blob[3:]
+    if compression == 'zlib':
+        payload = zlib.decompress(payload)
+    elif compression == 'zstd':
+        if zstandard is None:
+            raise ImportError("Item {} is zstd compressed, which needs zstandard "
+                              "installed".format(item.get('id')))
+        payload = zstandard.ZstdDecompressor().decompress(payload)
+    if serializer == 'msgpack':
+        if msgpack is None:
+            raise ImportError("Item {} is packed with msgpack, which needs "
+                              "msgpack installed".format(item.get('id')))
+        fields = msgpack.unpackb(payload, raw=False)
+    else:
+        fields = json.loads(payload.decode('utf-8'))
+    unpacked = {key: value for key, value in item.items() if key != 'blob'}
+    unpacked.update(fields)
+    return unpacked
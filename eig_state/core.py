@@ -1,57 +1,738 @@
+import collections
+import copy
+import decimal
+import logging
+import threading
+import time
+from eig_state.codec import unpack
+from eig_state.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+MAX_BATCH_ITEMS = 25
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+MAX_BATCH_GET_KEYS = 100
+MAX_TRANSACTION_ITEMS = 100
+MAX_CONFLICT_RETRIES = 5
+
+
+class ConflictError(RuntimeError):
+    """
+    Raised when a versioned item was changed by another writer since it was
+    loaded and the change couldn't be merged
+    """
+
+
+def item_size(value):
+    """
+    Estimates the number of bytes dynamodb bills for value
+    """
+    if isinstance(value, str):
+        return len(value.encode('utf-8'))
+    if isinstance(value, (bytes, bytearray)):
+        return len(value)
+    if isinstance(value, bool) or value is None:
+        return 1
+    if isinstance(value, (int, float, decimal.Decimal)):
+        return len(str(value)) // 2 + 2
+    if isinstance(value, dict):
+        return 3 + sum(item_size(k) + item_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple, set, frozenset)):
+        return 3 + sum(item_size(v) + 1 for v in value)
+    return len(str(value))
+
+
+# the attributes of dynamodb requests and responses holding the data sent
+# and received
+_SENT = ('Item', 'AttributeUpdates', 'ExpressionAttributeValues',
+         'RequestItems', 'TransactItems')
+_RECEIVED = ('Item', 'Responses')
+
+
+def dynamo_call(method, **kwargs):
+    """
+    Calls method, a dynamodb table or client method, with kwargs. While the
+    metrics registry is enabled the call is timed into the
+    eig_state_dynamo_seconds histogram and counted, along with the bytes
+    sent and received, by operation.
+    """
+    if not registry.enabled:
+        return method(**kwargs)
+    operation = method.__name__
+    with registry.span('eig_state_dynamo_seconds', operation=operation):
+        response = method(**kwargs)
+    registry.count('eig_state_dynamo_calls_total', operation=operation)
+    registry.count('eig_state_dynamo_bytes_total',
+                   sum(item_size(kwargs[key]) for key in _SENT if key in kwargs),
+                   operation=operation, direction='sent')
+    if isinstance(response, dict):
+        registry.count('eig_state_dynamo_bytes_total',
+                       sum(item_size(response[key]) for key in _RECEIVED
+                           if key in response),
+                       operation=operation, direction='received')
+    return response
+
+
+def _frozen(value):
+    if isinstance(value, dict):
+        return frozenset((key, _frozen(v)) for key, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(_frozen(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_frozen(v) for v in value)
+    return value
+
+
+def fingerprint(value):
+    """
+    Hash of the contents of value, so values that compare equal (including
+    dicts, lists and sets of equal values, and equal numbers whether int,
+    float or Decimal) get the same fingerprint. Like hash(), it only holds
+    within one process, and different values may share a fingerprint: only
+    different fingerprints tell values apart.
+    """
+    frozen = _frozen(value)
+    try:
+        return hash(frozen)
+    except TypeError:
+        return hash(repr(frozen))
+
+
+def version_condition(expected_version):
+    """
+    Keyword arguments for a put that only succeeds if the stored item is still
+    at expected_version, or has no version yet if that is 0
+    """
+    if not expected_version:
+        return {'ConditionExpression': 'attribute_not_exists(#version)',
+                'ExpressionAttributeNames': {'#version': 'version'}}
+    return {'ConditionExpression': '#version = :version',
+            'ExpressionAttributeNames': {'#version': 'version'},
+            'ExpressionAttributeValues': {':version': expected_version}}
+
+
+def update_expression(actions):
+    """
+    update_item arguments that SET each (path, value, append) action. path is
+    a tuple of attribute names and list indexes, and with append value is a
+    list added to the end of the one at path.
+    """
+    placeholders, values, clauses = {}, {}, []
+    for path, value, append in actions:
+        expression = ''
+        for part in path:
+            if isinstance(part, int):
+                expression += '[{}]'.format(part)
+            else:
+                placeholder = placeholders.setdefault(
+                    part, '#n{}'.format(len(placeholders)))
+                expression += ('.' if expression else '') + placeholder
+        value_name = ':v{}'.format(len(values))
+        values[value_name] = value
+        if append:
+            clauses.append('{0} = list_append({0}, {1})'
+                           .format(expression, value_name))
+        else:
+            clauses.append('{} = {}'.format(expression, value_name))
+    return {'UpdateExpression': 'SET ' + ', '.join(clauses),
+            'ExpressionAttributeNames': {placeholder: name for name, placeholder
+                                         in placeholders.items()},
+            'ExpressionAttributeValues': values}
+
+
+def append_actions(path, current, stored):
+    """
+    Actions updating the list at path, stored as (length, last element), to
+    current. Only suits lists that grow at the end and whose last element may
+    change; the whole list is set when more than that changed.
+    """
+    length, last = stored
+    if len(current) < length:
+        return [(path, current, False)]
+    actions = []
+    if length and current[length - 1] != last:
+        actions.append((path + (length - 1,), current[length - 1], False))
+    if len(current) > length:
+        if actions:
+            # a list and one of its elements can't be updated together
+            return [(path, current, False)]
+        actions.append((path, current[length:], True))
+    return actions
+
+
+def is_conflict(error):
+    """
+    Whether error is dynamodb refusing a write because its condition failed
+    """
+    response = getattr(error, 'response', None) or {}
+    code = response.get('Error', {}).get('Code')
+    if code == 'ConditionalCheckFailedException':
+        return True
+    return (code == 'TransactionCanceledException' and
+            any(reason.get('Code') == 'ConditionalCheckFailed'
+                for reason in response.get('CancellationReasons', [])))
+
+
+class Write:
+    """
+    An item to write and the object it was saved from. Writes with actions
+    update the stored item with them (see update_expression) rather than
+    replacing it with item. A write with an expected_version only succeeds if
+    the stored item is still at that version, and is made in one transaction
+    with its companions, unconditional writes to the same table. on_saved is
+    called once it is written.
+    """
+
+    __slots__ = ('table', 'item', 'owner', 'expected_version', 'companions',
+                 'on_saved', 'actions')
+
+    def __init__(self, table, item, owner=None, expected_version=None,
+                 companions=(), on_saved=None, actions=None):
+        self.table = table
+        self.item = item
+        self.owner = owner
+        self.expected_version = expected_version
+        self.companions = list(companions)
+        self.on_saved = on_saved
+        self.actions = actions
+
+    @property
+    def key(self):
+        return (self.table.name, self.item['id'])
+
+    @property
+    def slot(self):
+        """
+        Where the write waits in a batch or queue: writes of an item from
+        one owner are coalesced, while those from different owners (e.g. two
+        managers holding the same history) are kept apart and made one after
+        the other, so the later one's version check catches the earlier one
+        """
+        return self.key + (id(self.owner),)
+
+    @property
+    def conditional(self):
+        return self.expected_version is not None
+
+    @property
+    def batchable(self):
+        """
+        Whether this can go in a batch_write_item request
+        """
+        return (self.actions is None and not self.conditional and
+                all(write.batchable for write in self.companions))
+
+    def snapshot(self):
+        return Write(self.table, copy.deepcopy(self.item), self.owner,
+                     self.expected_version,
+                     [write.snapshot() for write in self.companions],
+                     self.on_saved, copy.deepcopy(self.actions))
+
+    def coalesce(self, older):
+        """
+        Folds an older, unwritten write of the same item by the same owner
+        into this one, so that it checks the version the older one expected
+        and carries the companions only the older one had. The updates of
+        both can't be combined, so the items they share are put whole.
+        """
+        if older.conditional and self.conditional:
+            self.expected_version = older.expected_version
+        self.actions = None
+        older_ids = {write.item['id'] for write in older.companions}
+        for write in self.companions:
+            if write.item['id'] in older_ids:
+                write.actions = None
+        ids = {write.item['id'] for write in self.companions}
+        self.companions = [write for write in older.companions
+                           if write.item['id'] not in ids] + self.companions
+
+    def arguments(self):
+        """
+        The put_item, or update_item if this has actions, arguments for it
+        """
+        if self.actions is None:
+            kwargs = {'Item': self.item}
+        else:
+            kwargs = dict(Key={'id': self.item['id']},
+                          **update_expression(self.actions))
+        if self.conditional:
+            condition = version_condition(self.expected_version)
+            kwargs['ConditionExpression'] = condition.pop('ConditionExpression')
+            for key, values in condition.items():
+                kwargs[key] = dict(kwargs.get(key, {}), **values)
+        return kwargs
+
+    def apply(self):
+        if self.actions is None:
+            dynamo_call(self.table.put_item, **self.arguments())
+        else:
+            dynamo_call(self.table.update_item, **self.arguments())
+
+    def transact_item(self):
+        return {'Put' if self.actions is None else 'Update':
+                dict(TableName=self.table.name, **self.arguments())}
+
+    def written(self):
+        if self.on_saved is not None:
+            self.on_saved()
+
+
+def write_item(write):
+    """
+    Makes write straight away, raising ConflictError if its version check
+    fails. Conditional writes with more companions than fit in a transaction
+    write the companions first.
+    """
+    companions = write.companions
+    if not write.conditional or len(companions) >= MAX_TRANSACTION_ITEMS:
+        for companion in companions:
+            companion.apply()
+        companions = []
+    try:
+        if companions:
+            dynamo_call(write.table.meta.client.transact_write_items,
+                        TransactItems=[companion.transact_item()
+                                       for companion in [write] + companions])
+        else:
+            write.apply()
+    except Exception as e:
+        if is_conflict(e):
+            raise ConflictError("{} in {} was changed by another writer"
+                                .format(write.item['id'], write.table.name)) from e
+        raise
+
+
+def put_item(table, item, owner=None, expected_version=None, companions=(),
+             on_saved=None, actions=None):
+    """
+    Writes item to table, or queues it on the active WriteBatch if there is
+    one. owner is the object the item was saved from. See Write for the rest.
+    """
+    write = Write(table, item, owner, expected_version, companions, on_saved,
+                  actions)
+    batch = WriteBatch.current()
+    if batch is None:
+        write_item(write)
+        write.written()
+    else:
+        batch.put(write)
+
+
+def get_items(table, ids, max_retries=8, backoff=0.05):
+    """
+    Fetches the items with the given ids from table using batch_get_item, 100
+    keys per request, retrying unprocessed keys with exponential backoff.
+    Returns a dict from id to item; ids that don't exist are left out.
+    """
+    found = {}
+    ids = list(collections.OrderedDict.fromkeys(ids))
+    for start in range(0, len(ids), MAX_BATCH_GET_KEYS):
+        request = {table.name: {
+            'Keys': [{'id': _id} for _id in ids[start:start + MAX_BATCH_GET_KEYS]]
+        }}
+        for attempt in range(max_retries + 1):
+            if attempt:
+                time.sleep(backoff * 2 ** (attempt - 1))
+            response = dynamo_call(table.meta.client.batch_get_item,
+                                   RequestItems=request)
+            for item in response['Responses'].get(table.name, []):
+                found[item['id']] = item
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+        else:
+            raise RuntimeError("DynamoDB left {} keys unprocessed after {} retries"
+                               .format(len(request[table.name]['Keys']),
+                                       max_retries))
+    return found
+
+
+class WriteBatch:
+    """
+    Collects every item saved while it is active and writes them with as few
+    batch_write_item requests as possible when the block exits.
+
+        with WriteBatch():
+            conv_history.save(conv_tbl)
+            user_history.save(user_tbl)
+
+    Repeated saves of the same item by the same object are coalesced, while
+    saves of it by different objects are written in turn. Requests are
+    capped at 25 items and 16MB, and unprocessed items are retried with
+    exponential backoff. Versioned writes and updates can't be batched and
+    are made one at a time after the rest; when a versioned one loses to
+    another writer its owner resolves the conflict and saves again, or with
+    resolve_conflicts off the write is only recorded in conflicts. A batch
+    opened inside another one hands its items to the outer batch instead of
+    writing them, and a batch given a queue (a WriteBehindQueue) hands them
+    to the queue.
+    """
+
+    _local = threading.local()
+
+    def __init__(self, max_retries=8, backoff=0.05, queue=None,
+                 resolve_conflicts=True):
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.queue = queue
+        self.resolve_conflicts = resolve_conflicts
+        self.items = collections.OrderedDict()
+        self.conflicts = []
+        self.outer = None
+
+    @classmethod
+    def current(cls):
+        return getattr(cls._local, 'batch', None)
+
+    def __enter__(self):
+        self.outer = self.current()
+        self._local.batch = self
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._local.batch = self.outer
+        if exc_type is None:
+            self.flush()
+        else:
+            self.discard()
+
+    def discard(self):
+        """
+        Drops the queued items, flagging their owners so they save again
+        """
+        for write in self.items.values():
+            if write.owner is not None:
+                write.owner.mark_dirty()
+        self.items = collections.OrderedDict()
+
+    def put(self, write):
+        older = self.items.pop(write.slot, None)
+        if older is not None:
+            write.coalesce(older)
+        self.items[write.slot] = write
+
+    def flush(self):
+        items, self.items = self.items, collections.OrderedDict()
+        if self.outer is not None or self.queue is not None:
+            target = self.outer if self.outer is not None else self.queue
+            for write in items.values():
+                target.put(write)
+            return
+        conflicts = []
+        try:
+            while items:
+                self.write_round(items, self.next_round(items), conflicts)
+        except Exception:
+            self.items = items
+            self.discard()
+            raise
+        self.conflicts.extend(conflicts)
+        if self.resolve_conflicts:
+            for write in conflicts:
+                if write.owner is None:
+                    raise ConflictError("{} in {} was changed by another writer"
+                                        .format(write.item['id'],
+                                                write.table.name))
+                write.owner.resolve_conflict(write.table)
+
+    @staticmethod
+    def next_round(items):
+        """
+        The slots of the first pending write of each item, which can be
+        written together
+        """
+        seen = set()
+        slots = []
+        for slot, write in items.items():
+            if write.key not in seen:
+                seen.add(write.key)
+                slots.append(slot)
+        return slots
+
+    def write_round(self, items, slots, conflicts):
+        """
+        Writes the items under slots, popping them from items as they are
+        written or found to conflict
+        """
+        by_client = collections.OrderedDict()
+        for slot in slots:
+            write = items[slot]
+            if write.batchable:
+                by_client.setdefault(write.table.meta.client, []).append(slot)
+        for client, keys in by_client.items():
+            for request, written in self.requests(items, keys):
+                self.write(client, request)
+                for key in written:
+                    items.pop(key).written()
+        for slot in slots:
+            if slot not in items:
+                continue
+            try:
+                write_item(items[slot])
+            except ConflictError:
+                conflicts.append(items.pop(slot))
+            else:
+                items.pop(slot).written()
+
+    def requests(self, items, keys):
+        """
+        Splits the items under keys into batch_write_item RequestItems that
+        stay within the request limits
+        """
+        request, written, count, size = {}, [], 0, 0
+        for key in keys:
+            write = items[key]
+            for item in [write.item] + [other.item for other in write.companions]:
+                nbytes = item_size(item)
+                if (count == MAX_BATCH_ITEMS or
+                        size + nbytes > MAX_BATCH_BYTES):
+                    yield request, written
+                    request, written, count, size = {}, [], 0, 0
+                request.setdefault(write.table.name, []).append(
+                    {'PutRequest': {'Item': item}})
+                count += 1
+                size += nbytes
+            written.append(key)
+        if request:
+            yield request, written
+
+    def write(self, client, request):
+        for attempt in range(self.max_retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            response = dynamo_call(client.batch_write_item,
+                                   RequestItems=request)
+            request = response.get('UnprocessedItems')
+            if not request:
+                return
+        raise RuntimeError("DynamoDB left {} items unprocessed after {} retries"
+                           .format(sum(len(v) for v in request.values()),
+                                   self.max_retries))
 
 
 class DynamoBackedObject:
+    """
+    Object saved as one dynamodb item. Versioned classes keep a version
+    attribute in their item and only overwrite the version they loaded, so
+    concurrent writers can't silently undo each other's saves: the loser
+    refreshes from the stored item and saves again.
+
+    Classes given a codec (an eig_state.codec.Codec) store their attributes
+    packed into one binary attribute, which is rewritten whole on every save,
+    so they save the attributes of the items they load along with those
+    registered. Items are unpacked on load whatever codec, if any, they were
+    written with.
+
+    Objects compare equal when their saved attributes do, skipping values
+    that are one and the same object. They hash by the fingerprints of
+    those attributes, which are computed once per value and dropped when it
+    is set or flagged with mark_dirty.
+    """
+
+    __slots__ = ()
+    versioned = False
+    codec = None
 
     def __init__(self, _id):
 
         self.id = _id
+        self.version = 0
+        self._stale = False
+        self._conflicts = 0
         self.savers = {'id': None}
+        self.mark_dirty()
+
+    def __setattr__(self, name, value):
+        super().__setattr__(name, value)
+        fingerprints = self.__dict__.get('_fingerprints')
+        if fingerprints:
+            fingerprints.pop(name, None)
+        savers = self.__dict__.get('savers')
+        if savers is not None and name in savers:
+            self.mark_dirty(name)
 
     def register_saver(self, var_name, saver=None):
         self.savers[var_name] = saver
+        self.mark_dirty(var_name)
+
+    def mark_dirty(self, var_name='id'):
+        """
+        Flags var_name as changed since the last save. Saved values that are
+        mutated in place (e.g. appending to a list) must be flagged by hand.
+        """
+        self.__dict__.setdefault('_dirty', set()).add(var_name)
+        fingerprints = self.__dict__.get('_fingerprints')
+        if fingerprints:
+            fingerprints.pop(var_name, None)
+
+    def fingerprint(self, var_name):
+        """
+        The fingerprint of the value of var_name (see fingerprint)
+        """
+        fingerprints = self.__dict__.get('_fingerprints')
+        if fingerprints is None:
+            fingerprints = self.__dict__['_fingerprints'] = {}
+        value = fingerprints.get(var_name)
+        if value is None:
+            value = fingerprints[var_name] = fingerprint(getattr(self, var_name))
+        return value
+
+    def same_value(self, var_name, other):
+        """
+        Whether var_name holds equal values in this and other, without
+        walking values that are one and the same object. Fingerprints aren't
+        used here: hashes collide (e.g. hash(-1) == hash(-2)), so a match
+        would have to be confirmed with == anyway, after walking both values
+        to compute them.
+        """
+        mine = getattr(self, var_name)
+        theirs = getattr(other, var_name)
+        return mine is theirs or mine == theirs
+
+    def mark_clean(self):
+        self._dirty = set()
+
+    @property
+    def dirty(self):
+        return bool(self._dirty)
 
     @classmethod
-    def from_dict(cls, item, *args):
+    def from_dict(cls, item, *args, **kwargs):
         """
         Parses mongo data and creates object
         """
+        item = unpack(item)
         try:
-            obj = cls(item['id'], *args)
+            obj = cls(item['id'], *args, **kwargs)
         except KeyError:
             raise KeyError("Must provide an id key when instantiating \
                            a dynamo object")
         for key, value in item.items():
-            if key == 'id':
-                continue
             setattr(obj, key, value)
+            if (obj.codec is not None and key not in obj.savers and
+                    key != 'version' and
+                    not isinstance(value, DynamoBackedObject)):
+                # packed items are put whole, so what was loaded is saved
+                # back along with what is registered
+                obj.register_saver(key)
+        obj.version = int(item.get('version', 0))
+        obj.mark_clean()
         return obj
 
     def save(self, table):
         """
-        Saves this to dynamodb
+        Saves this to dynamodb if it changed since it was loaded or last saved.
+        Savers always run so that nested objects get a chance to save. Items
+        that are already stored are updated with the changed attributes only.
         """
+        if self._stale:
+            self.refresh(table)
         item = {}
-        print(self.savers.items())
         for var_name, saver in self.savers.items():
             if saver:
-                print("Saver: ", saver)
+                logger.debug("Running saver %s", saver)
                 item = saver(item)
             else:
                 item[var_name] = getattr(self, var_name)
-        table.put_item(Item=item)
+        if not self.dirty:
+            return
+        if self.codec is None:
+            actions = self.update_actions(item)
+        else:
+            item = self.codec.pack(item)
+            actions = None
+        companions = self.companions(table)
+        if not self.versioned:
+            if actions != [] or companions:
+                put_item(table, item, self, companions=companions,
+                         actions=actions or None)
+            self.mark_clean()
+            return
+        item['version'] = self.version + 1
+        if actions is not None:
+            actions.append((('version',), item['version'], False))
+        try:
+            put_item(table, item, self, self.version, companions,
+                     self.write_callback(), actions)
+        except ConflictError:
+            self.resolve_conflict(table)
+            return
+        self.version += 1
+        self.mark_clean()
+
+    def update_actions(self, item):
+        """
+        The actions (see update_expression) bringing the stored item up to
+        date with item, or None if it has to be put whole because it was
+        never stored
+        """
+        if 'id' in self._dirty:
+            return None
+        return [((name,), item[name], False)
+                for name in sorted(self._dirty) if name in item]
+
+    def companions(self, table):
+        """
+        Writes of other items of the same table to make along with this one
+        """
+        return []
+
+    def write_callback(self):
+        """
+        Returns a function to call once the item being saved is written, or
+        None
+        """
+        return None
+
+    def resolve_conflict(self, table):
+        """
+        Called when another writer saved this since it was loaded: refreshes
+        it from the stored item and saves again, giving up with ConflictError
+        after MAX_CONFLICT_RETRIES tries
+        """
+        if self._conflicts >= MAX_CONFLICT_RETRIES:
+            raise ConflictError("{} in {} kept changing under {} saves"
+                                .format(self.id, table.name,
+                                        MAX_CONFLICT_RETRIES))
+        self._conflicts += 1
+        try:
+            self.refresh(table)
+            self.save(table)
+        finally:
+            self._conflicts -= 1
+
+    def refresh(self, table):
+        response = dynamo_call(table.get_item, Key={'id': self.id})
+        self.merge(response.get('Item', {'id': self.id}))
+        self._stale = False
+
+    def merge(self, item):
+        """
+        Takes in the stored item after another writer changed it. Only its
+        version is kept by default, so the values set here win.
+        """
+        self.version = int(item.get('version', 0))
+        self.mark_dirty()
+
+    def mark_stale(self):
+        """
+        Flags that a write of this made in the background lost to another
+        writer, so the next save refreshes it first
+        """
+        self._stale = True
+        self.mark_dirty()
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
-            equal = True
             for var in self.savers.keys():
-                if var == 'id':
-                    continue
-                equal &= getattr(self, var) == getattr(other, var)
-            return equal
+                if var != 'id' and not self.same_value(var, other):
+                    return False
+            return True
         return False
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __hash__(self):
-        return hash(tuple(sorted(self.__dict__.items())))
+        return hash(frozenset((var, self.fingerprint(var))
+                              for var in self.savers if var != 'id'))
@@ -1,18 +1,48 @@
+import logging
 import sys
+import threading
 import eig_state
 from eig_state.core import DynamoBackedObject
 
+logger = logging.getLogger(__name__)
+
 class History(DynamoBackedObject):
 
-    def __init__(self, _id, state_tbl, state_cls):
-        self.state_list = eig_state.state.StateList(None, state_tbl, state_cls)
+    versioned = True
+
+    def __init__(self, _id, state_tbl, state_cls, window=None):
+        self._state_list = None
+        # held by whoever changes or saves this, as a cached history is
+        # shared by the managers of its session or user
+        self.lock = threading.RLock()
         super().__init__(_id)
-        #TODO make past_states lazily evaluated so they only get brought into
-        #memory if they are called on
         self.state_tbl = state_tbl
-        print(self.state_list_saver)
+        self.state_cls = state_cls
+        self.window = window
+        self.state_list_id = None
         self.register_saver('state_list_id', self.state_list_saver)
 
+    @property
+    def state_list(self):
+        """
+        The list of past states. A loaded history only fetches its state list,
+        and the last `window` states of it, the first time this is used.
+        """
+        if self._state_list is None:
+            if self.state_list_id is None:
+                self.state_list = eig_state.state.StateList(
+                    None, self.state_tbl, self.state_cls)
+            else:
+                self._state_list = eig_state.state.StateList.load(
+                    self.state_list_id, self.state_tbl, self.state_cls,
+                    self.window)
+        return self._state_list
+
+    @state_list.setter
+    def state_list(self, state_list):
+        self._state_list = state_list
+        self.state_list_id = state_list.id
+
     def update(self, state):
         if isinstance(state, eig_state.state.State):
             if state.changed:
@@ -20,18 +50,41 @@ class History(DynamoBackedObject):
             else:
                 self.state_list.repeat_last()
 
+    def merge(self, item):
+        """
+        When another writer created this history first its state list is
+        kept, with the states added here appended to it
+        """
+        super().merge(item)
+        stored_id = item.get('state_list_id')
+        if stored_id is None or stored_id == self.state_list_id:
+            return
+        stored = eig_state.state.StateList.load(
+            stored_id, self.state_tbl, self.state_cls, self.window)
+        if self._state_list is not None:
+            for _id, count in self._state_list.runs:
+                for _ in range(count):
+                    stored.append(_id)
+            stored.states.update(self._state_list.states)
+        self.state_list = stored
+
     def state_list_saver(self, item):
-        item['state_list_id'] = self.state_list.id
-        self.state_list.save(self.state_tbl)
+        state_list = self._state_list
+        if state_list is None and self.state_list_id is None:
+            state_list = self.state_list
+        item['state_list_id'] = self.state_list_id
+        if state_list is not None:
+            state_list.save(self.state_tbl)
         return item
 
 class ConvHistory(History):
 
-    def __init__(self, _id, state_tbl, convid, userid, **kwargs):
-        super().__init__(_id, state_tbl, eig_state.state.ConvState, **kwargs)
+    def __init__(self, _id, state_tbl, convid, userid, state_cls=None, **kwargs):
+        super().__init__(_id, state_tbl, state_cls or eig_state.state.ConvState,
+                         **kwargs)
         self.userid = userid
         self.register_saver('userid')
-        print(convid)
+        logger.debug("Conv history %s for conv %s", _id, convid)
         if convid != "None":
             self.convid = convid
             self.register_saver('convid')
@@ -42,6 +95,7 @@ class ConvHistory(History):
 
 class UserHistory(History):
 
-    def __init__(self, _id, state_tbl, **kwargs):
-        super().__init__(_id, state_tbl, eig_state.state.UserState, **kwargs)
+    def __init__(self, _id, state_tbl, state_cls=None, **kwargs):
+        super().__init__(_id, state_tbl, state_cls or eig_state.state.UserState,
+                         **kwargs)
 
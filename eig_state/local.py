@@ -0,0 +1,190 @@
+import copy
+import re
+import threading
+from botocore.exceptions import ClientError
+
+
+class LocalTable:
+    """
+    In-memory stand-in for a boto3 dynamodb Table keyed on 'id'. Items are
+    copied on the way in and out, as they would be by a round trip, and kept
+    in items, a dict unless another mapping is given.
+    """
+
+    def __init__(self, name, client, items=None):
+        self.name = name
+        self.items = {} if items is None else items
+        self.meta = type('Meta', (), {'client': client})
+
+    def get_item(self, Key):
+        item = self.items.get(Key['id'])
+        if item is None:
+            return {}
+        return {'Item': copy.deepcopy(item)}
+
+    def put_item(self, Item, ConditionExpression=None,
+                 ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+        with self.meta.client.dynamo.transaction():
+            if not self.check(Item['id'], ConditionExpression,
+                              ExpressionAttributeNames,
+                              ExpressionAttributeValues):
+                raise ClientError({'Error': {
+                    'Code': 'ConditionalCheckFailedException',
+                    'Message': 'The conditional request failed'}}, 'PutItem')
+            self.items[Item['id']] = copy.deepcopy(Item)
+        return {}
+
+    def update_item(self, Key, UpdateExpression, ExpressionAttributeNames,
+                    ExpressionAttributeValues, ConditionExpression=None):
+        actions = self.parse(UpdateExpression, ExpressionAttributeNames,
+                             ExpressionAttributeValues)
+        with self.meta.client.dynamo.transaction():
+            if not self.check(Key['id'], ConditionExpression,
+                              ExpressionAttributeNames,
+                              ExpressionAttributeValues):
+                raise ClientError({'Error': {
+                    'Code': 'ConditionalCheckFailedException',
+                    'Message': 'The conditional request failed'}}, 'UpdateItem')
+            item = copy.deepcopy(self.items.get(Key['id'], Key))
+            for path, value, append in actions:
+                parent = item
+                for part in path[:-1]:
+                    parent = parent[part]
+                last = path[-1]
+                if append:
+                    parent[last] = parent[last] + value
+                elif isinstance(last, int) and last >= len(parent):
+                    parent.append(value)
+                else:
+                    parent[last] = value
+            self.items[Key['id']] = copy.deepcopy(item)
+        return {}
+
+    @staticmethod
+    def parse(expression, names, values):
+        """
+        Reads the SET actions of an update expression written by
+        eig_state.core.update_expression
+        """
+        if not expression.startswith('SET '):
+            raise NotImplementedError("LocalTable can't evaluate {!r}"
+                                      .format(expression))
+        actions = []
+        for match in re.finditer(r'(\S+) = (?:list_append\(\S+, (:\w+)\)|'
+                                 r'(:\w+))', expression[4:]):
+            path = [int(part[1:-1]) if part.startswith('[') else names[part]
+                    for part in re.findall(r'#\w+|\[\d+\]', match.group(1))]
+            if match.group(2):
+                actions.append((path, values[match.group(2)], True))
+            else:
+                actions.append((path, values[match.group(3)], False))
+        return actions
+
+    def check(self, _id, expression, names=None, values=None):
+        """
+        Evaluates the conditions eig_state writes with: attribute_not_exists
+        on an attribute, or an attribute equal to a value
+        """
+        if expression is None:
+            return True
+        names = names or {}
+        item = self.items.get(_id, {})
+        match = re.fullmatch(r'attribute_not_exists\((\S+)\)', expression)
+        if match:
+            return names.get(match.group(1), match.group(1)) not in item
+        match = re.fullmatch(r'(\S+) = (:\S+)', expression)
+        if match:
+            name = names.get(match.group(1), match.group(1))
+            return name in item and item[name] == values[match.group(2)]
+        raise NotImplementedError("LocalTable can't evaluate {!r}"
+                                  .format(expression))
+
+
+class LocalClient:
+    """
+    Stand-in for the client of a dynamodb resource, for batch calls
+    """
+
+    def __init__(self, dynamo):
+        self.dynamo = dynamo
+
+    def batch_get_item(self, RequestItems):
+        responses = {}
+        for name, request in RequestItems.items():
+            table = self.dynamo.Table(name)
+            responses[name] = [response['Item'] for response in
+                               map(table.get_item, request['Keys'])
+                               if 'Item' in response]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+    def batch_write_item(self, RequestItems):
+        for name, writes in RequestItems.items():
+            table = self.dynamo.Table(name)
+            for write in writes:
+                table.put_item(Item=write['PutRequest']['Item'])
+        return {'UnprocessedItems': {}}
+
+    def transact_write_items(self, TransactItems):
+        with self.dynamo.transaction():
+            return self._transact_write_items(TransactItems)
+
+    def _transact_write_items(self, TransactItems):
+        reasons = []
+        for request in TransactItems:
+            (kind, write), = request.items()
+            key = write['Item']['id'] if kind == 'Put' else write['Key']['id']
+            passed = self.dynamo.Table(write['TableName']).check(
+                key, write.get('ConditionExpression'),
+                write.get('ExpressionAttributeNames'),
+                write.get('ExpressionAttributeValues'))
+            reasons.append({'Code': 'None' if passed else 'ConditionalCheckFailed'})
+        if any(reason['Code'] != 'None' for reason in reasons):
+            raise ClientError({'Error': {
+                'Code': 'TransactionCanceledException',
+                'Message': 'Transaction cancelled'},
+                'CancellationReasons': reasons}, 'TransactWriteItems')
+        for request in TransactItems:
+            (kind, write), = request.items()
+            write = dict(write)
+            table = self.dynamo.Table(write.pop('TableName'))
+            write.pop('ConditionExpression', None)
+            if kind == 'Put':
+                table.put_item(Item=write['Item'])
+            else:
+                table.update_item(**write)
+        return {}
+
+
+class LocalDynamo:
+    """
+    In-memory stand-in for the boto3 dynamodb resource, for tests and local
+    runs. Tables are created the first time they are asked for. Given a
+    database, such as an eig_state.storage.SQLiteDatabase, tables keep their
+    items in it instead of in memory.
+    """
+
+    def __init__(self, database=None):
+        self.tables = {}
+        self.database = database
+        self.client = LocalClient(self)
+        self._lock = threading.RLock()
+
+    def Table(self, name):
+        table = self.tables.get(name)
+        if table is None:
+            with self._lock:
+                table = self.tables.get(name)
+                if table is None:
+                    items = (None if self.database is None
+                             else self.database.items(name))
+                    table = LocalTable(name, self.client, items)
+                    self.tables[name] = table
+        return table
+
+    def transaction(self):
+        """
+        Context in which a conditional write checks and writes atomically
+        """
+        if self.database is None:
+            return self._lock
+        return self.database.transaction()
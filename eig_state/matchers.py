@@ -0,0 +1,89 @@
+import collections
+
+
+class PhraseMatcher:
+    """
+    Aho-Corasick automaton that finds whether any of a fixed set of phrases
+    occurs as a substring of a text in a single pass over the text
+    """
+
+    def __init__(self, phrases):
+        self.goto = [{}]
+        self.fail = [0]
+        self.out = [False]
+        for phrase in phrases:
+            self.add(phrase)
+        self.build()
+
+    def add(self, phrase):
+        node = 0
+        for char in phrase:
+            nxt = self.goto[node].get(char)
+            if nxt is None:
+                nxt = len(self.goto)
+                self.goto[node][char] = nxt
+                self.goto.append({})
+                self.fail.append(0)
+                self.out.append(False)
+            node = nxt
+        self.out[node] = True
+
+    def build(self):
+        queue = collections.deque(self.goto[0].values())
+        while queue:
+            node = queue.popleft()
+            for char, nxt in self.goto[node].items():
+                queue.append(nxt)
+                fail = self.fail[node]
+                while fail and char not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[nxt] = self.goto[fail].get(char, 0)
+                self.out[nxt] = self.out[nxt] or self.out[self.fail[nxt]]
+
+    def search(self, text):
+        """
+        Returns True if any phrase is a substring of text
+        """
+        if self.out[0]:
+            return True
+        goto, fail, out = self.goto, self.fail, self.out
+        node = 0
+        for char in text:
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            if out[node]:
+                return True
+        return False
+
+
+class WordMatcher:
+    """
+    Hashed lookup of a word list. A token matches a word when the token both
+    starts and ends with that word, so only token prefixes whose length is
+    one of the word lengths need to be looked up.
+    """
+
+    def __init__(self, words):
+        self.words = frozenset(words)
+        self.lengths = sorted({len(word) for word in self.words if word})
+        self.matches_empty = '' in self.words
+
+    def match(self, token):
+        if self.matches_empty:
+            return True
+        words = self.words
+        size = len(token)
+        for length in self.lengths:
+            if length > size:
+                break
+            prefix = token[:length]
+            if prefix in words and token.endswith(prefix):
+                return True
+        return False
+
+    def search(self, tokens):
+        """
+        Returns True if any of the tokens matches a word
+        """
+        return any(self.match(token) for token in tokens)
@@ -0,0 +1,166 @@
+import json
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# the content type of render()'s output
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# upper bounds, in seconds, of the latency histograms' buckets
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1, 2.5, 5, 10)
+
+
+class _NullSpan:
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = _NullSpan()
+
+
+class Span:
+    """
+    Times the with block it guards into its Metrics' name histogram
+    """
+
+    __slots__ = ('metrics', 'name', 'labels', 'start')
+
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.start
+        if exc_type is not None:
+            self.labels = dict(self.labels, error=exc_type.__name__)
+        self.metrics.observe(self.name, seconds, **self.labels)
+        return False
+
+
+class Metrics:
+    """
+    Latency histograms and counters, labelled like Prometheus metrics.
+    span(name, **labels) times a with block into the name histogram and
+    count(name, value, **labels) adds to a counter. render() gives the
+    Prometheus text exposition of everything recorded and snapshot() the
+    same as a dict; with the eig_state.metrics logger at DEBUG every span is
+    also logged as a line of JSON.
+
+    Nothing is recorded while enabled is False, which is the default for
+    the process wide registry: spans are then a shared no-op.
+    """
+
+    def __init__(self, enabled=True, buckets=BUCKETS):
+        self.enabled = enabled
+        self.buckets = tuple(buckets)
+        self._histograms = {}
+        self._counters = {}
+        self._lock = threading.Lock()
+
+    def span(self, name, **labels):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, labels)
+
+    def observe(self, name, seconds, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [
+                    [0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if seconds <= bound:
+                    histogram[0][i] += 1
+                    break
+            histogram[1] += seconds
+            histogram[2] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(json.dumps(dict(labels, span=name, seconds=seconds)))
+
+    def count(self, name, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def reset(self):
+        with self._lock:
+            self._histograms.clear()
+            self._counters.clear()
+
+    def snapshot(self):
+        """
+        The recorded metrics as {'histograms': [...], 'counters': [...]},
+        each entry with its name and labels
+        """
+        with self._lock:
+            histograms = [{'name': name, 'labels': dict(labels),
+                           'buckets': dict(zip(self.buckets, counts)),
+                           'sum': total, 'count': n}
+                          for (name, labels), (counts, total, n)
+                          in sorted(self._histograms.items())]
+            counters = [{'name': name, 'labels': dict(labels), 'value': value}
+                        for (name, labels), value
+                        in sorted(self._counters.items())]
+        return {'histograms': histograms, 'counters': counters}
+
+    def render(self):
+        """
+        The recorded metrics in the Prometheus text exposition format
+        """
+        lines = []
+        typed = set()
+        snapshot = self.snapshot()
+        for histogram in snapshot['histograms']:
+            name = histogram['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} histogram'.format(name))
+            cumulative = 0
+            for bound, n in histogram['buckets'].items():
+                cumulative += n
+                lines.append('{}_bucket{} {}'.format(
+                    name, _labels(histogram['labels'], le=bound), cumulative))
+            lines.append('{}_bucket{} {}'.format(
+                name, _labels(histogram['labels'], le='+Inf'),
+                histogram['count']))
+            lines.append('{}_sum{} {}'.format(
+                name, _labels(histogram['labels']), histogram['sum']))
+            lines.append('{}_count{} {}'.format(
+                name, _labels(histogram['labels']), histogram['count']))
+        for counter in snapshot['counters']:
+            name = counter['name']
+            if name not in typed:
+                typed.add(name)
+                lines.append('# TYPE {} counter'.format(name))
+            lines.append('{}{} {}'.format(name, _labels(counter['labels']),
+                                          counter['value']))
+        return '\n'.join(lines) + '\n'
+
+
+def _labels(labels, **extra):
+    labels = dict(labels, **extra)
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(key, str(value).replace('"', '\\"'))
+                          for key, value in labels.items()) + '}'
+
+
+# the process wide registry eig_state records into; set its enabled to
+# start recording
+registry = Metrics(enabled=False)
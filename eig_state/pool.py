@@ -0,0 +1,63 @@
+import threading
+import boto3
+import botocore.config
+
+
+class DynamoPool:
+    """
+    Process wide source of dynamodb resources and table handles, so that
+    StateManagers built per request don't each pay for a new session,
+    resource and HTTP connection pool.
+
+    Every thread shares one resource, and so one client, whose pool keeps at
+    most max_connections open connections for the whole process; threads
+    beyond that wait for a free connection. boto3 clients are thread safe,
+    and tables are only used for their actions, which go straight to the
+    client, never for the lazily loaded attributes that make resources
+    unsafe to share.
+    """
+
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, region_name='us-east-1', max_connections=10):
+        self.region_name = region_name
+        self.max_connections = max_connections
+        self._lock = threading.Lock()
+        self._resource = None
+        self._tables = {}
+
+    @classmethod
+    def shared(cls, region_name='us-east-1'):
+        """
+        The pool used by every StateManager for region_name unless it is
+        given another
+        """
+        with cls._shared_lock:
+            pool = cls._shared.get(region_name)
+            if pool is None:
+                pool = cls(region_name)
+                cls._shared[region_name] = pool
+            return pool
+
+    def resource(self):
+        resource = self._resource
+        if resource is None:
+            config = botocore.config.Config(
+                max_pool_connections=self.max_connections)
+            with self._lock:
+                if self._resource is None:
+                    self._resource = boto3.session.Session().resource(
+                        'dynamodb', region_name=self.region_name,
+                        config=config)
+                resource = self._resource
+        return resource
+
+    def table(self, tbl_name):
+        table = self._tables.get(tbl_name)
+        if table is None:
+            resource = self.resource()
+            with self._lock:
+                table = self._tables.setdefault(tbl_name,
+                                                resource.Table(tbl_name))
+        return table
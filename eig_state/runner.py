@@ -0,0 +1,241 @@
+import concurrent.futures
+import logging
+import threading
+import time
+from eig_state.metrics import registry
+
+logger = logging.getLogger(__name__)
+
+
+class StateOverlay:
+    """
+    Stands in for a state while an extractor runs alongside others. Reads
+    fall through to the state, while writes and saver registrations are kept
+    aside until the runner applies them.
+    """
+
+    def __init__(self, state):
+        object.__setattr__(self, '_state', state)
+        object.__setattr__(self, '_values', {})
+        object.__setattr__(self, '_savers', [])
+
+    def __getattr__(self, name):
+        if name in self._values:
+            return self._values[name]
+        return getattr(self._state, name)
+
+    def __setattr__(self, name, value):
+        self._values[name] = value
+
+    def register_saver(self, var_name, saver=None):
+        self._savers.append((var_name, saver))
+
+    def apply(self):
+        for var_name, saver in self._savers:
+            self._state.register_saver(var_name, saver)
+        for name, value in self._values.items():
+            setattr(self._state, name, value)
+
+
+def input_var_names(extractor):
+    """
+    The state vars extractor reads, or None if it didn't declare them
+    """
+    return getattr(extractor, 'input_var_names', None)
+
+
+class ExtractorGraph:
+    """
+    Orders extractors by the state vars they read (input_var_names) and
+    write (state_var_names). levels groups the extractors so that everything
+    an extractor reads is written by an earlier group; extractors within a
+    group are independent and can run concurrently. Extractors that don't
+    declare their inputs depend on nothing.
+    """
+
+    def __init__(self, extractors):
+        self.extractors = tuple(extractors)
+        producers = {}
+        for extractor in self.extractors:
+            for var in extractor.state_var_names:
+                producers.setdefault(var, []).append(extractor)
+        self.deps = {}
+        for extractor in self.extractors:
+            deps = []
+            for var in input_var_names(extractor) or ():
+                for producer in producers.get(var, ()):
+                    if producer is not extractor and producer not in deps:
+                        deps.append(producer)
+            self.deps[extractor] = deps
+        self.has_inputs = any(input_var_names(extractor) is not None
+                              for extractor in self.extractors)
+        depths = {}
+        for extractor in self.extractors:
+            self._depth(extractor, [], depths)
+        self.levels = [[] for _ in range(max(depths.values(), default=-1) + 1)]
+        for extractor in self.extractors:
+            self.levels[depths[extractor]].append(extractor)
+
+    def _depth(self, extractor, path, depths):
+        if extractor in depths:
+            return depths[extractor]
+        if extractor in path:
+            cycle = path[path.index(extractor):] + [extractor]
+            raise ValueError("Extractor dependency cycle: {}".format(
+                " -> ".join(ext.__class__.__name__ for ext in cycle)))
+        path.append(extractor)
+        depth = 1 + max((self._depth(dep, path, depths)
+                         for dep in self.deps[extractor]), default=-1)
+        path.pop()
+        depths[extractor] = depth
+        return depth
+
+
+class ExtractorRunner:
+    """
+    Runs a state's extractors, the slow ones concurrently on a shared thread
+    pool.
+
+    Extractors run level by level in ExtractorGraph order. An extractor that
+    declares its inputs is skipped when those inputs equal the previous
+    state's, and its outputs are carried over instead. Extractors run on
+    the calling thread unless they have a timeout (their `timeout`
+    attribute, or the runner's) or are marked `slow`, as handing a cheap
+    extractor to the pool costs more than running it. When a level has
+    such extractors, they are handed to the pool and the rest run
+    meanwhile, every extractor seeing the state through its own
+    StateOverlay; the overlays are applied in extractor order once all of
+    them are done, so the resulting state doesn't depend on which thread
+    finished first. An extractor still running after its timeout is
+    abandoned and its state vars are carried over from the previous state.
+    With max_workers=0 every extractor runs on the calling thread.
+    """
+
+    def __init__(self, max_workers=None, timeout=None):
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = concurrent.futures.ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix='eig_state')
+        return self._pool
+
+    def timeout_for(self, extractor):
+        timeout = getattr(extractor, 'timeout', None)
+        return self.timeout if timeout is None else timeout
+
+    def offloaded(self, extractor):
+        """
+        Whether extractor runs on the pool rather than the calling thread
+        """
+        return (getattr(extractor, 'slow', False) or
+                self.timeout_for(extractor) is not None)
+
+    def run(self, extractors, state, history, *args):
+        """
+        Runs extractors (a sequence or an ExtractorGraph) on state and
+        returns whether any of them reported a change
+        """
+        graph = extractors
+        if not isinstance(graph, ExtractorGraph):
+            graph = ExtractorGraph(extractors)
+        last = None
+        if graph.has_inputs and history.state_list:
+            last = history.state_list[-1]
+        changed = False
+        for level in graph.levels:
+            pending = []
+            for extractor in level:
+                if (last is not None and
+                        self.inputs_unchanged(extractor, state, last)):
+                    self.carry_forward(extractor, state, last)
+                    registry.count('eig_state_extractor_skips_total',
+                                   extractor=extractor.__class__.__name__)
+                else:
+                    pending.append(extractor)
+            change = self.run_level(pending, state, history, *args)
+            changed = changed or change
+        return changed
+
+    def inputs_unchanged(self, extractor, state, last):
+        inputs = input_var_names(extractor)
+        if inputs is None:
+            return False
+        for var in list(inputs) + list(extractor.state_var_names):
+            if not hasattr(last, var):
+                return False
+        return all(getattr(state, var, None) == getattr(last, var)
+                   for var in inputs)
+
+    def run_level(self, extractors, state, history, *args):
+        if (self.max_workers == 0 or
+                not any(self.offloaded(extractor) for extractor in extractors)):
+            changed = False
+            for extractor in extractors:
+                change = self.call(extractor, state, history, *args)
+                changed = changed or change
+            return changed
+
+        start = time.monotonic()
+        overlays = [StateOverlay(state) for _ in extractors]
+        futures = [self.pool.submit(self.call, extractor, overlay, history, *args)
+                   if self.offloaded(extractor) else None
+                   for extractor, overlay in zip(extractors, overlays)]
+        results = [None if future is not None else
+                   self.call(extractor, overlay, history, *args)
+                   for extractor, overlay, future
+                   in zip(extractors, overlays, futures)]
+        changed = False
+        for extractor, overlay, future, result in zip(extractors, overlays,
+                                                      futures, results):
+            if future is None:
+                overlay.apply()
+                changed = changed or result
+                continue
+            timeout = self.timeout_for(extractor)
+            if timeout is not None:
+                timeout = max(0, start + timeout - time.monotonic())
+            try:
+                change = future.result(timeout)
+            except concurrent.futures.TimeoutError:
+                future.cancel()
+                logger.warning("Extractor %s timed out",
+                               extractor.__class__.__name__)
+                registry.count('eig_state_extractor_timeouts_total',
+                               extractor=extractor.__class__.__name__)
+                if history.state_list:
+                    self.carry_forward(extractor, state,
+                                       history.state_list[-1])
+                continue
+            overlay.apply()
+            changed = changed or change
+        return changed
+
+    def call(self, extractor, state, history, *args):
+        """
+        Runs extractor, timed into the eig_state_extractor_seconds histogram
+        """
+        with registry.span('eig_state_extractor_seconds',
+                           extractor=extractor.__class__.__name__):
+            return extractor(state, history, *args)
+
+    def carry_forward(self, extractor, state, last):
+        """
+        Copies the extractor's state vars from the last state
+        """
+        for var in extractor.state_var_names:
+            if hasattr(last, var):
+                state.register_saver(var)
+                setattr(state, var, getattr(last, var))
+
+    def shutdown(self, wait=True):
+        with self._lock:
+            if self._pool is not None:
+                self._pool.shutdown(wait)
+                self._pool = None
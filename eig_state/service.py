@@ -0,0 +1,249 @@
+import collections
+import contextlib
+import json
+import logging
+import threading
+import time
+from eig_state.cache import HistoryCache
+from eig_state.state_manager import StateManager, TurnOrderError
+from eig_state.metrics import registry
+from eig_state.storage import DynamoStorage, encode
+
+logger = logging.getLogger(__name__)
+
+
+class ManagerPool:
+    """
+    Live StateManagers by session, shared by every request a service process
+    handles. A conversation's next_round and set_response come in separate
+    requests, so they must find the same manager, and later turns reuse the
+    histories it loaded. Managers are built with manager_kwargs, which share
+    one storage and HistoryCache unless others are given.
+
+    Sessions are held one request at a time, and so are users: the
+    managers of a user's sessions share its UserHistory through the cache,
+    so turns of one user run one after another. Once there are more than
+    max_managers, the idle ones used longest ago are dropped; a dropped
+    session is reloaded on its next turn, but one dropped between
+    next_round and set_response has to start its turn again. So does one
+    whose set_response hasn't come turn_timeout seconds after its
+    next_round: the unfinished turn is discarded, rather than refusing the
+    session's turns for good.
+    """
+
+    def __init__(self, max_managers=1024, turn_timeout=300, **manager_kwargs):
+        manager_kwargs.setdefault('storage', DynamoStorage())
+        manager_kwargs.setdefault('cache', HistoryCache())
+        self.max_managers = max_managers
+        self.turn_timeout = turn_timeout
+        self.manager_kwargs = manager_kwargs
+        self._entries = collections.OrderedDict()
+        # userid: [lock, number of sessions holding or waiting for it]
+        self._users = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return self.manager_kwargs['cache']
+
+    @contextlib.contextmanager
+    def session(self, userid, convid, sessionid):
+        """
+        Holds the session's manager, making it if needed, and its user while
+        the with block runs
+        """
+        key = (userid, convid, sessionid)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = [None, threading.Lock()]
+            self._entries.move_to_end(key)
+            self._evict()
+            user = self._users.get(userid)
+            if user is None:
+                user = self._users[userid] = [threading.Lock(), 0]
+            user[1] += 1
+        try:
+            with entry[1], user[0]:
+                if entry[0] is None:
+                    entry[0] = StateManager(userid, convid, sessionid,
+                                            **self.manager_kwargs)
+                elif self._timed_out(entry[0]):
+                    logger.info("Discarding the unfinished turn of %s", key)
+                    entry[0].discard_turn()
+                yield entry[0]
+        finally:
+            with self._lock:
+                user[1] -= 1
+                if not user[1]:
+                    del self._users[userid]
+
+    def _timed_out(self, sm):
+        return (self.turn_timeout is not None and sm.turn_started is not None
+                and time.monotonic() - sm.turn_started > self.turn_timeout)
+
+    def _evict(self):
+        excess = len(self._entries) - self.max_managers
+        for key in list(self._entries):
+            if excess <= 0:
+                break
+            if not self._entries[key][1].locked():
+                del self._entries[key]
+                excess -= 1
+
+    def close(self, timeout=None):
+        """
+        Writes what the managers' write behind queue, if they have one, still
+        has pending and closes it, then closes the storage. Returns whether
+        everything was written within timeout seconds.
+        """
+        drained = True
+        queue = self.manager_kwargs.get('write_behind')
+        if queue is not None:
+            drained = queue.close(timeout)
+        self.manager_kwargs['storage'].close()
+        return drained
+
+    def stats(self):
+        stats = {'managers': len(self._entries)}
+        if self.cache is not None:
+            stats['cache'] = self.cache.stats()
+        return stats
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TurnError(Exception):
+    """
+    A turn request that can't be served, with the HTTP status to answer it
+    with and details to add to the answer
+    """
+
+    def __init__(self, message, status=400, **details):
+        super().__init__(message)
+        self.status = status
+        self.details = details
+
+    def payload(self):
+        return dict(self.details, error=str(self))
+
+
+# the service's endpoints, and the method each takes
+ENDPOINTS = {'/next_round': 'POST', '/set_response': 'POST', '/turns': 'POST',
+             '/batch': 'POST', '/health': 'GET', '/nodes': 'POST',
+             '/metrics': 'GET'}
+
+
+def handle(pool, method, path, body):
+    """
+    Answers a request to the state service with an HTTP status and a JSON
+    body, or for /metrics a text one. body is the request's parsed JSON
+    body, or None.
+
+    POST /next_round  {userid, convid, sessionid, question}
+    POST /set_response  {userid, convid, sessionid, response}
+    POST /turns  {userid, convid, sessionid, question and/or response}
+    POST /batch  {turns: [turn, ...]}, answered with a result per turn
+    GET /health
+    GET /metrics, the eig_state.metrics registry in the Prometheus format
+    POST /nodes  {nodes: [node, ...]}, the workers sharing sessions, for
+                 a ShardedManagerPool; answered with the sessions released
+                 and the writes that weren't drained in time
+    """
+    if path not in ENDPOINTS:
+        return 404, {'error': "No endpoint {}".format(path)}
+    if method != ENDPOINTS[path]:
+        return 405, {'error': "{} takes {} requests".format(path, ENDPOINTS[path])}
+    if path == '/health':
+        return 200, pool.stats()
+    if path == '/metrics':
+        return 200, registry.render()
+    if not isinstance(body, dict):
+        return 400, {'error': "Expected a JSON object"}
+    if path == '/nodes':
+        if not hasattr(pool, 'set_nodes'):
+            return 404, {'error': "Sessions aren't sharded"}
+        nodes = body.get('nodes')
+        if not isinstance(nodes, list) or not nodes:
+            return 400, {'error': "nodes needs a list of nodes"}
+        released = pool.set_nodes(nodes)
+        return 200, {'released': len(released),
+                     'pending_writes': pool.pending_writes()}
+    try:
+        if path == '/batch':
+            turns = body.get('turns')
+            if not isinstance(turns, list):
+                return 400, {'error': "batch needs a list of turns"}
+            return 200, {'results': run_turns(pool, turns)}
+        turn = dict(body)
+        if path == '/next_round':
+            turn.pop('response', None)
+            if 'question' not in turn:
+                return 400, {'error': "next_round needs a question"}
+        elif path == '/set_response':
+            turn.pop('question', None)
+            if 'response' not in turn:
+                return 400, {'error': "set_response needs a response"}
+        return 200, run_turn(pool, turn)
+    except TurnError as e:
+        return e.status, e.payload()
+    except Exception as e:
+        logger.exception("Request to %s failed", path)
+        return 500, {'error': str(e)}
+
+
+def state_values(state):
+    """
+    The saved values of state, as plain JSON data
+    """
+    values = {var: getattr(state, var) for var, saver in state.savers.items()
+              if saver is None}
+    return json.loads(encode(values))
+
+
+def run_turn(pool, turn):
+    """
+    Serves one turn given as a dict with userid, convid and sessionid: runs
+    next_round if it has a question, then set_response if it has a
+    response. Returns the conv and user states after next_round, and whether
+    the response was saved.
+    """
+    try:
+        ids = turn['userid'], turn['convid'], turn['sessionid']
+    except (KeyError, TypeError):
+        raise TurnError("A turn needs a userid, convid and sessionid")
+    if 'question' not in turn and 'response' not in turn:
+        raise TurnError("A turn needs a question, a response or both")
+    result = {}
+    with pool.session(*ids) as sm:
+        try:
+            if 'question' in turn:
+                sm.next_round(turn['question'])
+                result['conv_state'] = state_values(
+                    sm.conv_history.state_list[-1])
+                result['user_state'] = state_values(
+                    sm.user_history.state_list[-1])
+            if 'response' in turn:
+                sm.set_response(turn['response'])
+                result['saved'] = True
+        except TurnOrderError as e:
+            raise TurnError(str(e), 409)
+    return result
+
+
+def run_turns(pool, turns):
+    """
+    Serves turns in order, returning a result or an error for each. A
+    failed turn doesn't stop the ones after it.
+    """
+    results = []
+    for turn in turns:
+        try:
+            results.append(run_turn(pool, turn))
+        except TurnError as e:
+            results.append(dict(e.payload(), status=e.status))
+        except Exception as e:
+            logger.exception("Turn failed")
+            results.append({'error': str(e), 'status': 500})
+    return results
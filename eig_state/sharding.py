@@ -0,0 +1,158 @@
+import bisect
+import hashlib
+import logging
+import threading
+from eig_state.service import ManagerPool, TurnError
+from eig_state.write_behind import WriteBehindQueue
+
+logger = logging.getLogger(__name__)
+
+
+def _point(value):
+    return int.from_bytes(hashlib.md5(value.encode('utf-8')).digest()[:8], 'big')
+
+
+class HashRing:
+    """
+    Consistent hash ring mapping keys to nodes. Each node is placed at
+    replicas points, so keys spread evenly and adding or removing a node
+    only moves the keys of the ring segments it gains or loses.
+    """
+
+    def __init__(self, nodes=(), replicas=100):
+        self.replicas = replicas
+        self._points = []
+        self._owners = {}
+        for node in nodes:
+            self.add(node)
+
+    @property
+    def nodes(self):
+        return set(self._owners.values())
+
+    def add(self, node):
+        for i in range(self.replicas):
+            point = _point('{}#{}'.format(node, i))
+            if point not in self._owners:
+                bisect.insort(self._points, point)
+                self._owners[point] = node
+
+    def remove(self, node):
+        for point in [p for p, owner in self._owners.items() if owner == node]:
+            del self._owners[point]
+            self._points.remove(point)
+
+    def owner(self, key):
+        if not self._points:
+            raise ValueError("The ring has no nodes")
+        i = bisect.bisect(self._points, _point(key)) % len(self._points)
+        return self._owners[self._points[i]]
+
+
+class NotOwnerError(TurnError):
+    """
+    A turn sent to a worker that doesn't own its session
+    """
+
+    def __init__(self, key, owner):
+        super().__init__("{} is owned by {}".format(key, owner), 421,
+                         owner=owner)
+        self.owner = owner
+
+
+class ShardedManagerPool(ManagerPool):
+    """
+    The ManagerPool of node, one of the workers sharing sessions. Sessions
+    are spread over nodes by consistent hashing of their affinity key: the
+    userid by default, so one worker owns both histories a turn updates, or
+    the sessionid, which spreads a user's conversations over workers and
+    leaves their user history to be shared (and reconciled by its version).
+
+    The owner keeps its histories in memory and saves them through a write
+    behind queue. Turns of sessions other nodes own are refused with
+    NotOwnerError, which names the owner to send them to. When nodes join
+    or leave (set_nodes), sessions this node no longer owns are handed off:
+    their pending writes are flushed, waiting at most handoff_timeout
+    seconds, and their managers and cached histories dropped, so the new
+    owner loads what was last written.
+    Versioned history saves keep a turn that races the handoff from
+    undoing another's.
+    """
+
+    def __init__(self, node, nodes, replicas=100, affinity='userid',
+                 handoff_timeout=30, **manager_kwargs):
+        if affinity not in ('userid', 'sessionid'):
+            raise ValueError("affinity must be 'userid' or 'sessionid'")
+        manager_kwargs.setdefault('write_behind', WriteBehindQueue())
+        super().__init__(**manager_kwargs)
+        self.node = node
+        self.replicas = replicas
+        self.affinity = affinity
+        self.handoff_timeout = handoff_timeout
+        self.ring = HashRing(nodes, replicas)
+        self._ring_lock = threading.Lock()
+
+    def affinity_key(self, userid, sessionid):
+        return userid if self.affinity == 'userid' else sessionid
+
+    def owner(self, userid, convid, sessionid):
+        return self.ring.owner(self.affinity_key(userid, sessionid))
+
+    def session(self, userid, convid, sessionid):
+        owner = self.owner(userid, convid, sessionid)
+        if owner != self.node:
+            raise NotOwnerError(self.affinity_key(userid, sessionid), owner)
+        return super().session(userid, convid, sessionid)
+
+    def set_nodes(self, nodes):
+        """
+        Takes the nodes now sharing sessions and hands off the sessions
+        this node lost. Returns the keys of the managers it dropped.
+        """
+        with self._ring_lock:
+            self.ring = HashRing(nodes, self.replicas)
+            with self._lock:
+                lost = [(key, entry) for key, entry in self._entries.items()
+                        if self.owner(*key) != self.node]
+                for key, entry in lost:
+                    del self._entries[key]
+            for key, entry in lost:
+                # wait for a turn still running on the session
+                with entry[1]:
+                    pass
+            queue = self.manager_kwargs.get('write_behind')
+            if queue is not None and not queue.flush(self.handoff_timeout):
+                logger.warning("%d writes weren't drained within %s seconds "
+                               "of handing off %d sessions", len(queue),
+                               self.handoff_timeout, len(lost))
+            if self.cache is not None:
+                self.cache.invalidate_if(self._lost)
+        return [key for key, entry in lost]
+
+    def join(self, node):
+        return self.set_nodes(self.ring.nodes | {node})
+
+    def leave(self, node):
+        return self.set_nodes(self.ring.nodes - {node})
+
+    def pending_writes(self):
+        """
+        The writes the write behind queue still has to make
+        """
+        queue = self.manager_kwargs.get('write_behind')
+        return 0 if queue is None else len(queue)
+
+    def _lost(self, tbl_name, history):
+        userid = getattr(history, 'userid', None)
+        if tbl_name == self.manager_kwargs.get('user_tbl_name', 'users'):
+            if self.affinity == 'sessionid':
+                return False
+            userid = history.id
+        key = userid if self.affinity == 'userid' else history.id
+        return key is not None and self.ring.owner(key) != self.node
+
+    def stats(self):
+        stats = super().stats()
+        stats['node'] = self.node
+        stats['nodes'] = sorted(self.ring.nodes)
+        return stats
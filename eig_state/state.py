@@ -1,29 +1,43 @@
+import bisect
 import collections
+import copy
+import functools
+import itertools
+import logging
 import uuid
 from eig_state import state_extractors as se
 from eig_state import history as h
-from eig_state.core import DynamoBackedObject
+from eig_state.codec import unpack
+from eig_state.core import (ConflictError, DynamoBackedObject, Write,
+                            append_actions, dynamo_call, fingerprint,
+                            get_items)
+from eig_state.runner import ExtractorRunner
+
+logger = logging.getLogger(__name__)
 
 class State(DynamoBackedObject):
 
+    __slots__ = ()
+    runner = ExtractorRunner()
+    # what compact() builds its fields from: the vars set outside extractors
+    # and the type of the extractors that set the rest
+    fields = ()
+    extractor_type = None
+
     def __init__(self, extractors=[], **kwargs):
         _id = str(uuid.uuid1())
         super().__init__(_id)
         self.extractors = extractors
 
     def run_extractors(self, history, *args):
-        changed = False
         if isinstance(history, h.History):
             if isinstance(self.extractors, list):
-                for extractor in self.extractors:
-                    change = extractor(self, history, *args)
-                    changed = changed or change
+                extractors = self.extractors
             elif isinstance(self.extractors, str):
-                for extractor in se.StateExtractor.get_extractors(self.extractors):
-                    change = extractor(self, history, *args)
-                    changed = changed or change
+                extractors = se.registry.graph(self.extractors)
             else:
                 raise TypeError("extractor must be either list of extractors, or a string extractor type.")
+            changed = self.runner.run(extractors, self, history, *args)
 
             if history.state_list:
                 changed |= self != history.state_list[-1]
@@ -35,52 +49,384 @@ class State(DynamoBackedObject):
         elif history is not None:
             raise TypeError("history must be instance of History, not {}".format(type(history)))
 
+    @classmethod
+    def compact(cls):
+        """
+        Returns the CompactState class standing in for this one, with a field
+        for each of its fields and each state var of the extractors currently
+        registered for its type
+        """
+        fields = list(cls.fields)
+        for extractor in se.registry.get(cls.extractor_type):
+            for var in extractor.state_var_names:
+                if var not in fields:
+                    fields.append(var)
+        key = (cls, tuple(fields))
+        compact_cls = _compact_classes.get(key)
+        if compact_cls is None:
+            schema = ('id',) + key[1]
+            compact_cls = type('Compact' + cls.__name__, (CompactState,), {
+                '__slots__': key[1], 'schema': schema,
+                'extractors': cls.extractor_type,
+                '_index': {name: i for i, name in enumerate(schema)}})
+            _compact_classes[key] = compact_cls
+        return compact_cls
+
+    @classmethod
+    def packed(cls, codec):
+        """
+        Returns the subclass of this one storing its items packed by codec,
+        an eig_state.codec.Codec
+        """
+        key = (cls, codec)
+        packed_cls = _packed_classes.get(key)
+        if packed_cls is None:
+            packed_cls = type('Packed' + cls.__name__, (cls,), {
+                '__slots__': (), 'codec': codec})
+            _packed_classes[key] = packed_cls
+        return packed_cls
+
 class StateList(DynamoBackedObject, collections.abc.MutableSequence):
+    """
+    Sequence of state ids backed by the states table. Consecutive repeats of
+    an id are stored as a single [state_id, count] run, so size grows with
+    the number of distinct states rather than the number of turns.
+
+    The runs are stored in chunks of at most chunk_size runs, each its own
+    item keyed "<list id>#<chunk number>", next to a small header item holding
+    the number of turns in every chunk. Appending only rewrites the tail chunk
+    and the header, and indexing only loads the chunk it needs. Once stored,
+    the tail chunk and the header are updated in place, with list_append for
+    the new runs and chunk lengths.
+
+    The header is versioned and written in one transaction with the chunks
+    that changed. When another writer appended to the list first, the ids
+    appended here since the last save are appended again after theirs.
+    """
+
+    page_size = 100
+    chunk_size = 64
+    versioned = True
 
-    def __init__(self, _id, table, state_cls):
+    def __init__(self, _id, table, state_cls, chunk_size=None):
         if _id is None:
             _id = str(uuid.uuid1())
         DynamoBackedObject.__init__(self, _id)
         self.states = {}
-        self.state_ids = []
+        self._chunks = {}
+        self._ends = {}
+        self._dirty_chunks = set()
+        self._tails = {}
+        self._appends = collections.deque()
+        self._seq = 0
+        self._rebuilt = None
+        self.length = 0
+        self.chunk_lengths = []
+        self._offsets = []
+        if chunk_size is not None:
+            self.chunk_size = chunk_size
+        self.register_saver('length')
+        self.register_saver('chunk_size')
+        self.register_saver('chunk_lengths')
         self.register_saver('state_ids', self.state_saver)
         self.tbl = table
         self.state_cls = state_cls
 
+    @classmethod
+    def from_dict(cls, item, *args, **kwargs):
+        item = dict(unpack(item))
+        for key in ('length', 'chunk_size'):
+            if key in item:
+                item[key] = int(item[key])
+        derived = 'chunk_lengths' not in item and 'length' in item
+        if 'chunk_lengths' in item:
+            item['chunk_lengths'] = [int(n) for n in item['chunk_lengths']]
+        elif derived:
+            # chunks written before runs were used hold chunk_size ids each
+            full, rest = divmod(item['length'], item['chunk_size'])
+            item['chunk_lengths'] = [item['chunk_size']] * full + [rest] * bool(rest)
+        state_list = super().from_dict(item, *args, **kwargs)
+        if 'state_ids' in item:
+            # written before the ids were chunked, everything needs rewriting
+            state_list.mark_dirty()
+        else:
+            state_list._reindex()
+            if derived:
+                state_list.mark_dirty()
+        return state_list
+
+    @classmethod
+    def load(cls, _id, table, state_cls, window=None):
+        """
+        Loads the state list with the given id, bringing its last window
+        states into memory
+        """
+        response = dynamo_call(table.get_item, Key={'id': _id})
+        if 'Item' not in response:
+            raise ValueError("State id doesn't exist in dynamodb states table")
+        state_list = cls.from_dict(response['Item'], table, state_cls)
+        if window:
+            state_list.prefetch_last(window)
+        return state_list
+
+    def mark_dirty(self, var_name='id'):
+        super().mark_dirty(var_name)
+        if var_name == 'id' and '_chunks' in self.__dict__:
+            self._dirty_chunks.update(self._chunks)
+            self._tails = {}
+
+    def mark_clean(self):
+        super().mark_clean()
+        for n in self._dirty_chunks:
+            self._store_tail(n, self._chunks[n])
+        self._store_tail('chunk_lengths', self.chunk_lengths)
+        self._dirty_chunks = set()
+
+    def _store_tail(self, key, values):
+        # what append_actions needs to know about a stored list
+        self._tails[key] = (len(values),
+                            copy.deepcopy(values[-1]) if values else None)
+
+    def chunk_id(self, n):
+        return "{}#{}".format(self.id, n)
+
     def state_saver(self, item):
-        item['state_ids'] = self.state_ids
         for state_id in self.states:
             state = self.states[state_id]
             if isinstance(state, State):
                 state.save(self.tbl)
         return item
 
+    def update_actions(self, item):
+        actions = super().update_actions(item)
+        if actions is None or 'chunk_lengths' not in self._tails:
+            return None
+        actions = [action for action in actions
+                   if action[0] != ('chunk_lengths',)]
+        if 'chunk_lengths' in self._dirty:
+            actions += append_actions(('chunk_lengths',), self.chunk_lengths,
+                                      self._tails['chunk_lengths'])
+        return actions
+
+    def companions(self, table):
+        writes = []
+        for n in sorted(self._dirty_chunks):
+            runs = self._chunks[n]
+            actions = None
+            if n in self._tails:
+                actions = append_actions(('runs',), runs, self._tails[n])
+            writes.append(Write(table, {'id': self.chunk_id(n), 'runs': runs},
+                                actions=actions))
+        return writes
+
+    def write_callback(self):
+        return functools.partial(self._written, self._seq)
+
+    def _written(self, seq):
+        while self._appends and self._appends[0][0] < seq:
+            self._appends.popleft()
+        if self._rebuilt is not None and self._rebuilt < seq:
+            self._rebuilt = None
+
+    def merge(self, item):
+        """
+        Takes the stored header in place of this one and appends the ids
+        appended here since the last save. Lists that were rewritten in the
+        middle since then can't be merged.
+        """
+        if self._rebuilt is not None:
+            raise ConflictError("StateList {} was changed by another writer "
+                                "while it was being rewritten".format(self.id))
+        pending = [_id for seq, _id in self._appends]
+        stored = type(self).from_dict(item, self.tbl, self.state_cls)
+        self.version = stored.version
+        self.length = stored.length
+        self.chunk_size = stored.chunk_size
+        self.chunk_lengths = stored.chunk_lengths
+        self._offsets = stored._offsets
+        self._chunks = stored._chunks
+        self._ends = stored._ends
+        self._dirty_chunks = set(stored._dirty_chunks)
+        self._tails = stored._tails
+        self._appends.clear()
+        for _id in pending:
+            self._append_id(_id)
+
+    @property
+    def runs(self):
+        """
+        Every [state_id, count] run in the list, loading all of its chunks
+        """
+        self._load_chunks(range(len(self.chunk_lengths)))
+        return [run for n in range(len(self.chunk_lengths))
+                for run in self._chunks[n]]
+
+    @property
+    def state_ids(self):
+        """
+        Every id in the list, one per turn
+        """
+        return [_id for _id, count in self.runs for _ in range(count)]
+
+    @state_ids.setter
+    def state_ids(self, state_ids):
+        runs = []
+        for _id in state_ids:
+            if runs and runs[-1][0] == _id:
+                runs[-1][1] += 1
+            else:
+                runs.append([_id, 1])
+        size = self.chunk_size
+        self._chunks = {n // size: runs[n:n + size]
+                        for n in range(0, len(runs), size)}
+        self._ends = {}
+        self._dirty_chunks = set(self._chunks)
+        self._tails = {}
+        self.chunk_lengths = [sum(count for _id, count in self._chunks[n])
+                              for n in range(len(self._chunks))]
+        self.length = len(state_ids)
+        self._reindex()
+
+    def _reindex(self):
+        if not self.chunk_lengths:
+            # an empty list has no chunks, so the first append starts chunk 0
+            self._offsets = []
+            return
+        self._offsets = list(itertools.accumulate([0] + self.chunk_lengths[:-1]))
+
+    def _chunk_ends(self, n):
+        ends = self._ends.get(n)
+        if ends is None:
+            ends = list(itertools.accumulate(count for _id, count in self._chunks[n]))
+            self._ends[n] = ends
+        return ends
+
+    def _locate(self, key):
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("StateList index out of range")
+        n = bisect.bisect_right(self._offsets, key) - 1
+        self._load_chunks([n])
+        return n, bisect.bisect_right(self._chunk_ends(n), key - self._offsets[n])
+
+    def _load_chunks(self, chunks):
+        missing = [n for n in chunks if n not in self._chunks]
+        if not missing:
+            return
+        items = get_items(self.tbl, [self.chunk_id(n) for n in missing])
+        for n in missing:
+            item = items.get(self.chunk_id(n), {})
+            if 'runs' in item:
+                runs = [[_id, int(count)] for _id, count in item['runs']]
+            else:
+                runs = []
+                for _id in item.get('state_ids', []):
+                    if runs and runs[-1][0] == _id:
+                        runs[-1][1] += 1
+                    else:
+                        runs.append([_id, 1])
+            self._chunks[n] = runs
+            if 'runs' in item:
+                self._store_tail(n, runs)
+
+    def _ids(self, key):
+        if not isinstance(key, slice):
+            n, r = self._locate(key)
+            return [self._chunks[n][r][0]]
+        keys = range(*key.indices(self.length))
+        if not keys:
+            return []
+        first = bisect.bisect_right(self._offsets, min(keys)) - 1
+        last = bisect.bisect_right(self._offsets, max(keys)) - 1
+        self._load_chunks(range(first, last + 1))
+        return [self._chunks[n][r][0] for n, r in map(self._locate, keys)]
+
     def __getitem__(self, key):
-        _id = self.state_ids[key]
+        _id = self._ids(key)[0]
         return (_id in self.states and self.states[_id]) or self.get_state(_id)
 
     def get_state(self, _id):
-        response = self.tbl.get_item(Key={'id': _id})
-        return self.state_cls.from_dict(response['Item'])
+        response = dynamo_call(self.tbl.get_item, Key={'id': _id})
+        state = self.state_cls.from_dict(response['Item'])
+        self.states[_id] = state
+        return state
+
+    def prefetch(self, key=slice(None)):
+        """
+        Brings the states at key (an index or a slice) into memory, fetching
+        the ones that aren't loaded yet with batch_get_item
+        """
+        missing = [_id for _id in self._ids(key) if _id not in self.states]
+        for _id, item in get_items(self.tbl, missing).items():
+            self.states[_id] = self.state_cls.from_dict(item)
+
+    def prefetch_last(self, k):
+        """
+        Brings the last k states into memory
+        """
+        if k > 0:
+            self.prefetch(slice(-k, None))
 
     def __setitem__(self, key, value):
         if isinstance(value, State):
-            _id = value.id
-            self.states[_id] = value
-            self.state_ids[key] = _id
-        elif isinstance(value, str):
-            self.state_ids[key] = value
+            self.states[value.id] = value
+            value = value.id
+        if isinstance(value, str):
+            self._locate(key)
+            state_ids = self.state_ids
+            state_ids[key] = value
+            self._rebuild(state_ids)
 
     def __delitem__(self, key):
-        del self.states[self.state_ids[key]]
+        del self.states[self._ids(key)[0]]
 
     def insert(self, key, value):
         if isinstance(value, State):
-            self.state_ids.insert(key, value.id)
-            print(self.states)
             self.states[value.id] = value
-        elif isinstance(value, str):
-            self.state_ids.insert(key, value)
+            value = value.id
+        if not isinstance(value, str):
+            return
+        if key < 0:
+            key = max(key + self.length, 0)
+        if key >= self.length:
+            self._append_id(value)
+        else:
+            state_ids = self.state_ids
+            state_ids.insert(key, value)
+            self._rebuild(state_ids)
+
+    def _rebuild(self, state_ids):
+        self.state_ids = state_ids
+        self._rebuilt = self._seq
+        self._seq += 1
+
+    def _append_id(self, _id):
+        n = len(self.chunk_lengths) - 1
+        runs = None
+        if n >= 0:
+            self._load_chunks([n])
+            runs = self._chunks[n]
+            ends = self._chunk_ends(n)
+        if runs and runs[-1][0] == _id:
+            runs[-1][1] += 1
+            ends[-1] += 1
+            self.chunk_lengths[n] += 1
+        elif runs is not None and len(runs) < self.chunk_size:
+            runs.append([_id, 1])
+            ends.append(self.chunk_lengths[n] + 1)
+            self.chunk_lengths[n] += 1
+        else:
+            n += 1
+            self._chunks[n] = [[_id, 1]]
+            self._ends[n] = [1]
+            self._offsets.append(self.length)
+            self.chunk_lengths.append(1)
+        self._dirty_chunks.add(n)
+        self.mark_dirty('chunk_lengths')
+        self.length += 1
+        self._appends.append((self._seq, _id))
+        self._seq += 1
 
     def append(self, value):
         self.insert(len(self), value)
@@ -89,41 +435,156 @@ class StateList(DynamoBackedObject, collections.abc.MutableSequence):
         query = item
         if isinstance(item, State):
             query = item.id
-        return query in self.state_ids
+        return any(_id == query for _id, count in self.runs)
 
     def __len__(self):
-        return len(self.state_ids)
+        return self.length
 
     def __iter__(self):
-        for key in range(len(self)):
-            yield self.__getitem__(key)
+        for start in range(0, len(self), self.page_size):
+            stop = start + self.page_size
+            self.prefetch(slice(start, stop))
+            for key in range(start, min(stop, len(self))):
+                yield self.__getitem__(key)
 
     def __nonzero__(self):
         return len(self) != 0
 
     def repeat_last(self):
-        self.state_ids.append(self.state_ids[-1])
+        self.append(self._ids(-1)[0])
 
 
 class ConvState(State):
 
+    fields = ('question', 'response')
+    extractor_type = "conv"
+
     def __init__(self, question=None, extractors=None, **kwargs):
         self.question = question
         if isinstance(extractors, list):
             super().__init__(extractors, **kwargs)
         else:
-            super().__init__(extractors="conv", **kwargs)
+            super().__init__(extractors=self.extractor_type, **kwargs)
         self.register_saver('question')
 
 class UserState(State):
 
+    extractor_type = "user"
+
     def __init__(self, extractors=None, **kwargs):
         if isinstance(extractors, list):
             super().__init__(extractors, **kwargs)
         else:
-            super().__init__(extractors="user", **kwargs)
+            super().__init__(extractors=self.extractor_type, **kwargs)
 
     def run_extractors(self, user_hist, conv_hist):
         super().run_extractors(user_hist, conv_hist)
 
 
+_compact_classes = {}
+_packed_classes = {}
+
+
+class CompactState(State):
+    """
+    State keeping its fields in __slots__ instead of an instance __dict__,
+    for processes holding many states. The fields, and so the saver schema,
+    are fixed per class (see State.compact): which fields are registered to
+    be saved and which changed since the last save are kept as bit masks over
+    the schema. Attributes of loaded items that aren't fields are kept aside
+    and saved back as they were.
+    """
+
+    __slots__ = ('id', 'changed', '_saved', '_changed', '_extra',
+                 '_fingerprints')
+    schema = ('id',)
+    _index = {'id': 0}
+    # states aren't versioned, so these never change
+    version = 0
+    _stale = False
+
+    def __init__(self, question=None, extractors=None):
+        if extractors is not None and extractors != self.extractors:
+            raise TypeError("Compact states run the extractors registered for "
+                            "their type")
+        object.__setattr__(self, '_saved', 1)
+        object.__setattr__(self, '_changed', 1)
+        object.__setattr__(self, '_extra', None)
+        object.__setattr__(self, '_fingerprints', {})
+        object.__setattr__(self, 'id', str(uuid.uuid1()))
+        if 'question' in self._index:
+            self.question = question
+            self.register_saver('question')
+
+    @classmethod
+    def from_dict(cls, item, *args, **kwargs):
+        item = unpack(item)
+        if 'id' not in item:
+            raise KeyError("Must provide an id key when instantiating \
+                           a dynamo object")
+        obj = cls.__new__(cls)
+        saved = 0
+        extra = None
+        for key, value in item.items():
+            i = cls._index.get(key)
+            if i is None:
+                if extra is None:
+                    extra = {}
+                extra[key] = value
+            else:
+                object.__setattr__(obj, key, value)
+                saved |= 1 << i
+        object.__setattr__(obj, '_saved', saved)
+        object.__setattr__(obj, '_changed', 0)
+        object.__setattr__(obj, '_extra', extra)
+        object.__setattr__(obj, '_fingerprints', {})
+        return obj
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        self._fingerprints.pop(name, None)
+        i = self._index.get(name)
+        if i is not None and self._saved >> i & 1:
+            object.__setattr__(self, '_changed', self._changed | 1 << i)
+
+    def register_saver(self, var_name, saver=None):
+        i = self._index.get(var_name)
+        if i is None or saver is not None:
+            raise ValueError("{} has no field {}".format(type(self).__name__,
+                                                         var_name))
+        bit = 1 << i
+        object.__setattr__(self, '_saved', self._saved | bit)
+        object.__setattr__(self, '_changed', self._changed | bit)
+
+    @property
+    def savers(self):
+        savers = {name: None for i, name in enumerate(self.schema)
+                  if self._saved >> i & 1}
+        if self._extra:
+            savers['_extra'] = self._save_extra
+        return savers
+
+    def _save_extra(self, item):
+        for key, value in self._extra.items():
+            item.setdefault(key, value)
+        return item
+
+    @property
+    def _dirty(self):
+        return {name for i, name in enumerate(self.schema)
+                if self._changed >> i & 1}
+
+    def mark_dirty(self, var_name='id'):
+        object.__setattr__(self, '_changed',
+                           self._changed | 1 << self._index[var_name])
+        self._fingerprints.pop(var_name, None)
+
+    def fingerprint(self, var_name):
+        value = self._fingerprints.get(var_name)
+        if value is None:
+            value = self._fingerprints[var_name] = fingerprint(
+                getattr(self, var_name))
+        return value
+
+    def mark_clean(self):
+        object.__setattr__(self, '_changed', 0)
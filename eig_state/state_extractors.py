@@ -1,11 +1,81 @@
 import abc
+import threading
+from eig_state.runner import ExtractorGraph
 from eig_state.swear_words import words as swears
 from eig_state.swear_words import phrases
+from eig_state.matchers import PhraseMatcher, WordMatcher
 import re
 
 
+class ExtractorRegistry:
+    """
+    Process wide set of state extractors. Each registered extractor class is
+    instantiated once, the first time extractors are looked up (or on
+    warm_up), and the instances are indexed by their type as an
+    ExtractorGraph. Dependency cycles are reported when the graphs are built.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._classes = []
+        self._instances = {}
+        self._by_type = None
+
+    def register(self, extractor_cls):
+        with self._lock:
+            if extractor_cls not in self._classes:
+                self._classes.append(extractor_cls)
+                self._by_type = None
+        return extractor_cls
+
+    def unregister(self, extractor_cls):
+        with self._lock:
+            if extractor_cls in self._classes:
+                self._classes.remove(extractor_cls)
+                self._instances.pop(extractor_cls, None)
+                self._by_type = None
+
+    def warm_up(self):
+        """
+        Builds the registered extractors that haven't been built yet
+        """
+        with self._lock:
+            if self._by_type is None:
+                by_type = {}
+                for extractor_cls in self._classes:
+                    ext = self._instances.get(extractor_cls)
+                    if ext is None:
+                        ext = extractor_cls()
+                        self._instances[extractor_cls] = ext
+                    by_type.setdefault(ext.type, []).append(ext)
+                self._by_type = {ext_type: ExtractorGraph(exts)
+                                 for ext_type, exts in by_type.items()}
+            return self._by_type
+
+    def graph(self, extractor_type):
+        by_type = self._by_type
+        if by_type is None:
+            by_type = self.warm_up()
+        graph = by_type.get(extractor_type)
+        if graph is None:
+            graph = ExtractorGraph(())
+        return graph
+
+    def get(self, extractor_type):
+        return self.graph(extractor_type).extractors
+
+
 class StateExtractor(metaclass=abc.ABCMeta):
 
+    # set on extractors slow enough to be worth running on the runner's
+    # thread pool, alongside the others of their level
+    slow = False
+
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        if StateExtractor in cls.__bases__:
+            registry.register(cls)
+
     @abc.abstractmethod
     def __call__(self, state, history):
         """
@@ -26,19 +96,26 @@ class StateExtractor(metaclass=abc.ABCMeta):
         Returns type of the extractor, i.e. convextractor or userextractor
         """
 
+    @property
+    def input_var_names(self):
+        """
+        Returns names of the state variables this extractor reads, or None if
+        it may read anything. Extractors that declare their inputs run after
+        the extractors producing them, and are skipped when none of them
+        changed since the previous state.
+        """
+        return None
+
     @classmethod
     def get_extractors(cls, extractor_type):
-        extractors = []
-        for extractor in cls.__subclasses__():
-            ext = extractor()
-            if ext.type == extractor_type:
-                extractors.append(ext)
-        return extractors
+        return registry.get(extractor_type)
 
     def __call__(self, state, history):
         for var in self.state_var_names:
             state.register_saver(var)
 
+registry = ExtractorRegistry()
+
 ## NOT IMPLEMENTED
 class NamedEntityExtractor(StateExtractor):
 
@@ -89,6 +166,10 @@ class UserNameExtractor(StateExtractor):
 
 class ProfanityDetector(StateExtractor):
 
+    separators = re.compile(r"[;,:.?\-! ]")
+    _word_matcher = None
+    _phrase_matcher = None
+
     @property
     def type(self):
         return "conv"
@@ -97,16 +178,29 @@ class ProfanityDetector(StateExtractor):
     def state_var_names(self):
         return ['has_swear']
 
+    @property
+    def input_var_names(self):
+        return ['question']
+
     def __call__(self, state, history):
         super().__call__(state, history)
         state.has_swear = self.contains_profanity(state.question)
         return True
 
+    @classmethod
+    def compile(cls):
+        """
+        Builds the swear word and phrase matchers, shared by all instances
+        """
+        if cls._word_matcher is None:
+            cls._phrase_matcher = PhraseMatcher(phrases)
+            cls._word_matcher = WordMatcher(swears)
+
     def contains_profanity(self, text):
-        words = re.split(";|,|\:|\.|\?|\-|\!| ", text)
-        has_swear = any(word.lower().startswith(swear) and word.lower().endswith(swear) for word in words for swear in swears)
-        has_bad_phrase = any(phrase in text for phrase in phrases)
-        return has_swear or has_bad_phrase
+        self.compile()
+        words = self.separators.split(text.lower())
+        return (self._word_matcher.search(words) or
+                self._phrase_matcher.search(text))
 
 class AdviceDetector(StateExtractor):
 
@@ -118,6 +212,10 @@ class AdviceDetector(StateExtractor):
     def state_var_names(self):
         return ['asks_advice']
 
+    @property
+    def input_var_names(self):
+        return ['question']
+
     def __call__(self, state, history):
         super().__call__(state, history)
         state.asks_advice = "should i" in state.question.lower()
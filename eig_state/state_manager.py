@@ -1,31 +1,81 @@
+import contextlib
+import logging
+import time
 from eig_state import state
 from eig_state import history
-import boto3
+from eig_state.core import WriteBatch, dynamo_call
+from eig_state.metrics import registry
+from eig_state.storage import DynamoStorage, ResourceStorage
+
+logger = logging.getLogger(__name__)
+
+
+class TurnOrderError(RuntimeError):
+    """
+    next_round or set_response called out of turn
+    """
+
 
 class StateManager:
 
     def __init__(self, userid, convid, sessionid, state_tbl_name='states',
-                 user_tbl_name='users', conv_tbl_name='conversations'):
+                 user_tbl_name='users', conv_tbl_name='conversations',
+                 window=None, dynamo=None, pool=None, write_behind=None,
+                 cache=None, storage=None, compact=False, codec=None):
+        """
+        With window set, histories are loaded lazily: their state lists are
+        only fetched on first use, along with the last window states, and
+        older states are fetched on demand. Tables come from storage, an
+        eig_state.storage.Storage, which by default is dynamodb through pool,
+        the process wide DynamoPool unless another is given, or through
+        dynamo, a dynamodb resource or stand-in for one.
+        With a WriteBehindQueue as write_behind, set_response hands its writes
+        to the queue instead of waiting for them. Histories are looked up in
+        cache, a HistoryCache, before being loaded; managers then share the
+        cached history of their session or user, and hold its lock whenever
+        they change it.
+        With compact set, states are CompactStates, which hold their fields in
+        slots and take far less memory. Given a codec (an
+        eig_state.codec.Codec), states are stored packed by it, in far
+        smaller items.
+        """
         self.state_tbl_name = state_tbl_name
+        self.window = window
+        self.write_behind = write_behind
+        self.cache = cache
         self.conv_tbl_name = conv_tbl_name
         self.user_tbl_name = user_tbl_name
-        self._tbls = {}
-        self.dynamo = boto3.resource('dynamodb', region_name='us-east-1')
+        self.conv_state_cls = state.ConvState
+        self.user_state_cls = state.UserState
+        if compact:
+            self.conv_state_cls = self.conv_state_cls.compact()
+            self.user_state_cls = self.user_state_cls.compact()
+        if codec is not None:
+            self.conv_state_cls = self.conv_state_cls.packed(codec)
+            self.user_state_cls = self.user_state_cls.packed(codec)
+        if storage is None:
+            if dynamo is None:
+                storage = DynamoStorage(pool)
+            else:
+                storage = ResourceStorage(dynamo)
+        self.storage = storage
+        self.dynamo = storage.resource
+        self.ids = (userid, convid, sessionid)
+        self.load(userid, convid, sessionid)
+        self.ready_for_q = True
+        self.turn_started = None
+
+    def load(self, userid, convid, sessionid):
         self.conv_history = self.get_conv_history(sessionid, convid, userid)
         self.user_history = self.get_user_history(userid)
-        self.ready_for_q = True
 
     def retrieve_item(self, tbl_name, key):
         table = self.get_table(tbl_name)
-        response = table.get_item(Key={'id': key})
+        response = dynamo_call(table.get_item, Key={'id': key})
         return 'Item' in response and response['Item']
 
     def get_table(self, tbl_name):
-        table = self._tbls.get(tbl_name)
-        if table is None:
-            table = self.dynamo.Table(tbl_name)
-            self._tbls[tbl_name] = table
-        return table
+        return self.storage.table(tbl_name)
 
     def get_conv_history(self, sessionid, convid, userid):
         """
@@ -37,51 +87,117 @@ class StateManager:
         return new ConvHistory()
         """
         return self.get_history(sessionid, self.conv_tbl_name, history.ConvHistory,
-                                state.ConvState, convid, userid)
+                                self.conv_state_cls, convid, userid)
 
     def get_user_history(self, userid):
 
         return self.get_history(userid, self.user_tbl_name, history.UserHistory,
-                                state.UserState)
+                                self.user_state_cls)
+
+    def get_cached_history(self, tbl_name, hist_id):
+        if self.cache is not None:
+            return self.cache.get(tbl_name, hist_id)
+
+    def cache_history(self, tbl_name, hist):
+        if self.cache is not None:
+            self.cache.put(tbl_name, hist)
 
     def get_history(self, hist_id, tbl_name, cls, state_cls, *args):
 
-        item = self.retrieve_item(tbl_name, hist_id)
-        if item:
-            state_list = self.get_state_list(item['state_list_id'], state_cls)
-            print(state_list.states)
-            item['state_list'] = state_list
-            hist = cls.from_dict(item, self.get_table(self.state_tbl_name), *args)
-        else:
-            print("conv id not found, creating new doc")
-            hist = cls(hist_id, self.get_table(self.state_tbl_name), *args)
-            hist.save(self.get_table(tbl_name))
+        hist = self.get_cached_history(tbl_name, hist_id)
+        if hist is not None:
+            return hist
+        with registry.span('eig_state_history_load_seconds', table=tbl_name):
+            item = self.retrieve_item(tbl_name, hist_id)
+            state_list = None
+            if item and self.window is None:
+                state_list = self.get_state_list(item['state_list_id'],
+                                                 state_cls)
+            hist = self.build_history(hist_id, item, state_list, cls,
+                                      state_cls, *args)
+        if not item:
+            self.save_history(tbl_name, hist)
+        self.cache_history(tbl_name, hist)
         return hist
 
+    def save_history(self, tbl_name, hist):
+        with registry.span('eig_state_history_save_seconds', table=tbl_name):
+            hist.save(self.get_table(tbl_name))
 
-    def get_state_list(self, _id, state_cls):
-        item = self.retrieve_item(self.state_tbl_name, _id)
+    def build_history(self, hist_id, item, state_list, cls, state_cls, *args):
+        """
+        Makes a history from its item and, if it was loaded, its state list.
+        Without an item a new, unsaved history is made.
+        """
+        state_tbl = self.get_table(self.state_tbl_name)
         if item:
-            print(item)
-            tbl = self.get_table(self.state_tbl_name)
-            return state.StateList.from_dict(item, tbl, state_cls)
-        raise ValueError("State id doesn't exist in dynamodb states table")
+            if state_list is not None:
+                item['state_list'] = state_list
+            return cls.from_dict(item, state_tbl, *args, window=self.window,
+                                 state_cls=state_cls)
+        logger.debug("History %s not found, creating it", hist_id)
+        return cls(hist_id, state_tbl, *args, window=self.window,
+                   state_cls=state_cls)
+
+
+    def get_state_list(self, _id, state_cls):
+        tbl = self.get_table(self.state_tbl_name)
+        return state.StateList.load(_id, tbl, state_cls)
 
     def next_round(self, question):
         if not self.ready_for_q:
-            raise RuntimeError("Must call set_response before you can call next_round again")
-        conv_state = state.ConvState(question)
-        user_state = state.UserState()
-        conv_state.run_extractors(self.conv_history)
-        user_state.run_extractors(self.user_history, self.conv_history)
+            raise TurnOrderError("Must call set_response before you can call next_round again")
+        with self.holding_histories(), \
+                registry.span('eig_state_turn_seconds', step='next_round'):
+            conv_state = self.conv_state_cls(question)
+            user_state = self.user_state_cls()
+            conv_state.run_extractors(self.conv_history)
+            user_state.run_extractors(self.user_history, self.conv_history)
         self.ready_for_q = False
+        self.turn_started = time.monotonic()
         return self
 
     def set_response(self, response):
         if self.ready_for_q:
-            raise RuntimeError("Must call next_round before you can call set_response again.")
-        self.conv_history.set_last_response(response)
-        self.conv_history.save(self.get_table(self.conv_tbl_name))
-        self.user_history.save(self.get_table(self.user_tbl_name))
+            raise TurnOrderError("Must call next_round before you can call set_response again.")
+        with self.holding_histories():
+            self.conv_history.set_last_response(response)
+            try:
+                with registry.span('eig_state_turn_seconds', step='set_response'):
+                    with WriteBatch(queue=self.write_behind):
+                        self.save_history(self.conv_tbl_name, self.conv_history)
+                        self.save_history(self.user_tbl_name, self.user_history)
+            except Exception:
+                if self.cache is not None:
+                    self.cache.invalidate(self.conv_tbl_name, self.conv_history.id)
+                    self.cache.invalidate(self.user_tbl_name, self.user_history.id)
+                raise
+            self.cache_history(self.conv_tbl_name, self.conv_history)
+            self.cache_history(self.user_tbl_name, self.user_history)
         self.ready_for_q = True
+        self.turn_started = None
 
+    def discard_turn(self):
+        """
+        Drops the turn next_round started and set_response didn't finish, by
+        reloading the histories as they were last saved
+        """
+        if self.ready_for_q:
+            return
+        with self.holding_histories():
+            if self.cache is not None:
+                self.cache.invalidate(self.conv_tbl_name, self.conv_history.id)
+                self.cache.invalidate(self.user_tbl_name, self.user_history.id)
+        self.load(*self.ids)
+        self.ready_for_q = True
+        self.turn_started = None
+
+    @contextlib.contextmanager
+    def holding_histories(self):
+        """
+        Holds the locks of the conv and user histories, which managers of
+        the same session or user share through the cache, while the with
+        block changes them
+        """
+        with self.conv_history.lock, self.user_history.lock:
+            yield
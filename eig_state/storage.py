@@ -0,0 +1,208 @@
+import abc
+import base64
+import collections.abc
+import decimal
+import json
+import sqlite3
+import threading
+from eig_state.local import LocalDynamo
+from eig_state.pool import DynamoPool
+
+
+class Storage(metaclass=abc.ABCMeta):
+    """
+    Where histories and states are kept. table(name) returns a table with the
+    part of the boto3 dynamodb Table API eig_state uses: get_item, put_item
+    and update_item (with the conditions and update expressions written by
+    eig_state.core), and meta.client.batch_get_item, batch_write_item and
+    transact_write_items.
+    """
+
+    resource = None
+
+    @abc.abstractmethod
+    def table(self, name):
+        """
+        The table called name
+        """
+
+    def close(self):
+        pass
+
+
+class ResourceStorage(Storage):
+    """
+    Tables of a boto3 dynamodb resource, or of a stand-in for one
+    """
+
+    def __init__(self, resource):
+        self.resource = resource
+        self._tables = {}
+
+    def table(self, name):
+        table = self._tables.get(name)
+        if table is None:
+            table = self.resource.Table(name)
+            self._tables[name] = table
+        return table
+
+
+class DynamoStorage(Storage):
+    """
+    DynamoDB, through pool (the process wide DynamoPool by default)
+    """
+
+    def __init__(self, pool=None):
+        self.pool = pool or DynamoPool.shared()
+
+    @property
+    def resource(self):
+        return self.pool.resource()
+
+    def table(self, name):
+        return self.pool.table(name)
+
+
+class MemoryStorage(ResourceStorage):
+    """
+    Tables kept in this process's memory, gone when it exits
+    """
+
+    def __init__(self):
+        super().__init__(LocalDynamo())
+
+
+class SQLiteStorage(ResourceStorage):
+    """
+    Tables kept in the SQLite database at path, for load tests and single
+    node deployments without network round trips
+    """
+
+    def __init__(self, path=':memory:'):
+        self.database = SQLiteDatabase(path)
+        super().__init__(LocalDynamo(self.database))
+
+    def close(self):
+        self.database.close()
+
+
+def encode(item):
+    return json.dumps(item, default=_encode_value, separators=(',', ':'))
+
+
+def _encode_value(value):
+    if isinstance(value, decimal.Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, (set, frozenset)):
+        return sorted(value)
+    if isinstance(value, (bytes, bytearray)):
+        return {'__bytes__': base64.b64encode(value).decode('ascii')}
+    raise TypeError("Can't store {!r}".format(value))
+
+
+def _decode_object(value):
+    if len(value) == 1 and '__bytes__' in value:
+        return base64.b64decode(value['__bytes__'])
+    return value
+
+
+def decode(text):
+    # numbers come back as Decimals, as they do from dynamodb
+    return json.loads(text, parse_int=decimal.Decimal,
+                      parse_float=decimal.Decimal, object_hook=_decode_object)
+
+
+class SQLiteDatabase:
+    """
+    An SQLite database holding the items of every table as JSON, keyed by
+    table name and id. One connection is shared by all threads.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._connection = sqlite3.connect(path, check_same_thread=False,
+                                           isolation_level=None)
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS items (tbl TEXT, id TEXT, item TEXT, "
+            "PRIMARY KEY (tbl, id)) WITHOUT ROWID")
+        self._lock = threading.RLock()
+        self._depth = 0
+
+    def items(self, name):
+        return SQLiteItems(self, name)
+
+    def transaction(self):
+        return _Transaction(self)
+
+    def execute(self, sql, *args):
+        with self._lock:
+            return self._connection.execute(sql, args).fetchall()
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class _Transaction:
+    # reentrant: only the outermost one begins and commits
+
+    def __init__(self, database):
+        self.database = database
+
+    def __enter__(self):
+        database = self.database
+        database._lock.acquire()
+        if not database._depth:
+            database._connection.execute("BEGIN")
+        database._depth += 1
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        database = self.database
+        database._depth -= 1
+        try:
+            if not database._depth:
+                database._connection.execute(
+                    "COMMIT" if exc_type is None else "ROLLBACK")
+        finally:
+            database._lock.release()
+
+
+class SQLiteItems(collections.abc.MutableMapping):
+    """
+    The items of one table in an SQLiteDatabase, by id
+    """
+
+    def __init__(self, database, name):
+        self.database = database
+        self.name = name
+
+    def __getitem__(self, _id):
+        rows = self.database.execute(
+            "SELECT item FROM items WHERE tbl = ? AND id = ?", self.name, _id)
+        if not rows:
+            raise KeyError(_id)
+        return decode(rows[0][0])
+
+    def __setitem__(self, _id, item):
+        self.database.execute(
+            "INSERT OR REPLACE INTO items (tbl, id, item) VALUES (?, ?, ?)",
+            self.name, _id, encode(item))
+
+    def __delitem__(self, _id):
+        if _id not in self:
+            raise KeyError(_id)
+        self.database.execute("DELETE FROM items WHERE tbl = ? AND id = ?",
+                              self.name, _id)
+
+    def __contains__(self, _id):
+        return bool(self.database.execute(
+            "SELECT 1 FROM items WHERE tbl = ? AND id = ?", self.name, _id))
+
+    def __iter__(self):
+        rows = self.database.execute("SELECT id FROM items WHERE tbl = ?",
+                                     self.name)
+        return iter([row[0] for row in rows])
+
+    def __len__(self):
+        return self.database.execute(
+            "SELECT COUNT(*) FROM items WHERE tbl = ?", self.name)[0][0]
@@ -0,0 +1,251 @@
+"""
+Benchmarks of the state manager's hot paths, run against in-memory tables.
+
+    python -m eig_state.tests.benchmark [--quick] [--output results.json]
+                                        [--compare baseline.json]
+
+Each benchmark reports its throughput and p50/p99 latency, per call or, for
+the state list benchmarks, per block of states. Results are saved
+as JSON along with the commit they were measured at, and compared with a
+baseline saved the same way: benchmarks slower than the baseline by more
+than --threshold are reported as regressions, and the exit status is 1.
+"""
+import argparse
+import datetime
+import itertools
+import json
+import platform
+import subprocess
+import sys
+import time
+from eig_state import state as s
+from eig_state import state_extractors as se
+from eig_state.history import ConvHistory, UserHistory
+from eig_state.state_manager import StateManager
+from eig_state.storage import MemoryStorage
+
+STATE_LIST_SIZES = (10, 1000, 100000)
+QUICK_STATE_LIST_SIZES = (10, 1000, 10000)
+QUESTION_LENGTHS = (5, 50, 500)
+# latencies sampled per run of a state list benchmark, so that even a single
+# run has enough of them for a p99
+BLOCKS = 100
+WORDS = ("so what do you think about the weather today friend it looks like "
+         "rain but the forecast said sun").split()
+
+
+def percentile(values, q):
+    """
+    The q-th percentile of the sorted values, by nearest rank
+    """
+    rank = max(0, min(len(values) - 1, int(round(q / 100 * len(values))) - 1))
+    return values[rank]
+
+
+def summarize(latencies, ops_per_call=1):
+    latencies = sorted(latencies)
+    total = sum(latencies)
+    return {'calls': len(latencies),
+            'ops_per_sec': len(latencies) * ops_per_call / total if total else None,
+            'p50': percentile(latencies, 50),
+            'p99': percentile(latencies, 99),
+            'mean': total / len(latencies)}
+
+
+def measure(func, repeat, setup=None, ops_per_call=1):
+    """
+    Calls func repeat times, with what setup returns if it is given, and
+    summarizes the latencies of the calls. setup isn't timed.
+    """
+    latencies = []
+    for _ in range(repeat):
+        args = () if setup is None else (setup(),)
+        start = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - start)
+    return summarize(latencies, ops_per_call)
+
+
+def measure_blocks(func, size, runs, setup, prepare=None, blocks=BLOCKS):
+    """
+    Times a benchmark of size operations in blocks: each run calls
+    func(obj, start, stop) for consecutive ranges splitting range(size) into
+    blocks, on the obj setup returns, and the latency of each block is a
+    sample. prepare(obj, start, stop), if given, is called before each block
+    and isn't timed.
+    """
+    blocks = min(blocks, size)
+    bounds = [size * i // blocks for i in range(blocks + 1)]
+    latencies = []
+    for _ in range(runs):
+        obj = setup()
+        for start, stop in zip(bounds, bounds[1:]):
+            if prepare is not None:
+                prepare(obj, start, stop)
+            begin = time.perf_counter()
+            func(obj, start, stop)
+            latencies.append(time.perf_counter() - begin)
+    return summarize(latencies, size / blocks)
+
+
+def question(n_words):
+    return ' '.join(WORDS[i % len(WORDS)] for i in range(n_words))
+
+
+def bench_profanity(repeat):
+    detector = se.ProfanityDetector()
+    detector.compile()
+    results = {}
+    for n_words in QUESTION_LENGTHS:
+        text = question(n_words)
+        results['contains_profanity/{}_words'.format(n_words)] = measure(
+            lambda: detector.contains_profanity(text), repeat)
+    return results
+
+
+def bench_run_extractors(repeat):
+    table = MemoryStorage().table('states')
+    conv_history = ConvHistory('bench', table, 'convid', 'userid')
+    user_history = UserHistory('userid', table)
+    questions = iter([question(10 + i % 20) for i in range(repeat)])
+    return {'run_extractors/conv': measure(
+                lambda state: state.run_extractors(conv_history), repeat,
+                setup=lambda: s.ConvState(next(questions))),
+            'run_extractors/user': measure(
+                lambda state: state.run_extractors(user_history, conv_history),
+                repeat, setup=s.UserState)}
+
+
+def bench_state_list(sizes, repeat):
+    """
+    Appends size states to a list, iterates over a list of size states
+    loaded from storage, and saves a list growing to size states, a block
+    of states at a time
+    """
+    table = MemoryStorage().table('states')
+    results = {}
+    for size in sizes:
+        # lists shorter than BLOCKS give fewer samples per run
+        runs = max(-(-BLOCKS // size), min(repeat, 100000 // size))
+
+        def new_list():
+            return s.StateList(None, table, s.ConvState)
+
+        def append(state_list, start, stop):
+            for i in range(start, stop):
+                state_list.append(s.ConvState(str(i), extractors=[]))
+
+        saved = new_list()
+        append(saved, 0, size)
+        saved.save(table)
+
+        def reloaded():
+            return iter(s.StateList.load(saved.id, table, s.ConvState))
+
+        def iterate(states, start, stop):
+            for _ in itertools.islice(states, stop - start):
+                pass
+
+        results['state_list/append/{}'.format(size)] = measure_blocks(
+            append, size, runs, new_list)
+        results['state_list/iterate/{}'.format(size)] = measure_blocks(
+            iterate, size, runs, reloaded)
+        results['state_list/save/{}'.format(size)] = measure_blocks(
+            lambda state_list, start, stop: state_list.save(table), size,
+            runs, new_list, prepare=append)
+    return results
+
+
+def bench_cycles(repeat):
+    storage = MemoryStorage()
+    sm = StateManager('userid', 'convid', 'sessionid', storage=storage)
+    questions = iter([question(10 + i % 20) for i in range(repeat)])
+
+    def cycle():
+        sm.next_round(next(questions))
+        sm.set_response("ok")
+
+    return {'cycle/next_round+set_response': measure(cycle, repeat)}
+
+
+def run(quick=False, repeat=None):
+    """
+    Runs every benchmark and returns the results with the commit, python
+    and time they were measured at
+    """
+    if repeat is None:
+        repeat = 50 if quick else 500
+    sizes = QUICK_STATE_LIST_SIZES if quick else STATE_LIST_SIZES
+    results = {}
+    results.update(bench_profanity(repeat))
+    results.update(bench_run_extractors(repeat))
+    results.update(bench_state_list(sizes, max(3, repeat // 10)))
+    results.update(bench_cycles(repeat))
+    return {'commit': commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            'quick': quick,
+            'results': results}
+
+
+def commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results, baseline, threshold=0.2):
+    """
+    The benchmarks in both results and baseline whose p50 grew by more than
+    threshold, as (name, baseline p50, p50) tuples
+    """
+    regressions = []
+    for name, result in sorted(results['results'].items()):
+        before = baseline['results'].get(name)
+        if before is not None and result['p50'] > before['p50'] * (1 + threshold):
+            regressions.append((name, before['p50'], result['p50']))
+    return regressions
+
+
+def report(results, out=sys.stdout):
+    out.write('{:<40} {:>14} {:>12} {:>12}\n'.format('benchmark', 'ops/s',
+                                                     'p50 ms', 'p99 ms'))
+    for name, result in sorted(results['results'].items()):
+        out.write('{:<40} {:>14.1f} {:>12.4f} {:>12.4f}\n'.format(
+            name, result['ops_per_sec'] or 0, result['p50'] * 1000,
+            result['p99'] * 1000))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--quick', action='store_true',
+                        help="fewer repeats and at most 10k states")
+    parser.add_argument('--repeat', type=int)
+    parser.add_argument('--output', help="file to save the results to")
+    parser.add_argument('--compare', help="results file to compare with")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="p50 slowdown reported as a regression")
+    args = parser.parse_args(argv)
+
+    results = run(args.quick, args.repeat)
+    report(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for name, before, after in regressions:
+            print("Regression: {} p50 {:.4f} ms -> {:.4f} ms".format(
+                name, before * 1000, after * 1000))
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,9 +1,33 @@
+import asyncio
+import copy
+import decimal
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
 import unittest
 
 from eig_state import state as s
 from eig_state import history as h
 from eig_state import state_extractors as se
 from eig_state import state_manager
+from eig_state import matchers
+from eig_state import core
+from eig_state import runner
+from eig_state import aio
+from eig_state import local
+from eig_state import write_behind
+from eig_state import pool
+from eig_state import cache
+from eig_state import storage
+from eig_state import codec
+from eig_state import service
+from eig_state import asgi
+from eig_state import sharding
+from eig_state import metrics
+from eig_state.tests import benchmark
 from eig_state.tests import utils
 
 import boto3
@@ -69,8 +93,12 @@ def create_tables(dynamo):
     )
 
 def setUpDynamo(cls):
+   # the test tables live in moto's mock dynamodb for the class's tests
+   mock = mock_dynamodb2()
+   mock.start()
+   cls.addClassCleanup(mock.stop)
    cls.dynamo = boto3.resource('dynamodb', region_name='us-east-1')
-   #create_tables(cls.dynamo)
+   create_tables(cls.dynamo)
    cls.state_tbl = cls.dynamo.Table('test_states')
    cls.conv_tbl = cls.dynamo.Table('test_conversations')
 
@@ -112,6 +140,124 @@ class TestConvHistory(unittest.TestCase):
         self.assertEqual(self.history.state_list[-1].response, response)
 
 
+    def test_save_writes_only_changes(self):
+        state_tbl = utils.CountingTable(self.state_tbl)
+        history = h.ConvHistory("dirty_sessionid", state_tbl, "convid",
+                                "userid")
+        for text in ["one", "two", "three"]:
+            s.ConvState(text, extractors=[]).run_extractors(history)
+        history.save(self.conv_tbl)
+        self.assertEqual(len(state_tbl.puts), 5)
+
+        state_tbl.puts = []
+        history.save(self.conv_tbl)
+        self.assertEqual(state_tbl.puts, [])
+
+        new_state = s.ConvState("four", extractors=[])
+        new_state.run_extractors(history)
+        history.set_last_response("five")
+        history.save(self.conv_tbl)
+        self.assertCountEqual(state_tbl.puts,
+                              [history.state_list.id,
+                               history.state_list.chunk_id(0),
+                               new_state.id])
+
+
+class TestStateList(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setUpDynamo(cls)
+
+    def setUp(self):
+        state_list = s.StateList(None, self.state_tbl, s.ConvState)
+        for i in range(150):
+            state_list.append(s.ConvState(str(i), extractors=[]))
+        state_list.save(self.state_tbl)
+        item = self.state_tbl.get_item(Key={'id': state_list.id})['Item']
+        self.state_list = s.StateList.from_dict(item, self.state_tbl,
+                                                s.ConvState)
+
+    def test_reloaded_empty_list_appends(self):
+        state_list = s.StateList(None, self.state_tbl, s.ConvState)
+        state_list.save(self.state_tbl)
+        state_list = s.StateList.load(state_list.id, self.state_tbl, s.ConvState)
+        state_list.append(s.ConvState("first", extractors=[]))
+        self.assertEqual(state_list[-1].question, "first")
+        state_list.save(self.state_tbl)
+        state_list = s.StateList.load(state_list.id, self.state_tbl, s.ConvState)
+        self.assertEqual([state.question for state in state_list], ["first"])
+
+    def test_first_turn_after_reloading_new_history(self):
+        dynamo = local.LocalDynamo()
+        state_manager.StateManager("u", "c", "s", dynamo=dynamo)
+        sm = state_manager.StateManager("u", "c", "s", dynamo=dynamo)
+        sm.next_round("hello")
+        sm.set_response("hi")
+        self.assertEqual(sm.conv_history.state_list[-1].response, "hi")
+
+    def test_append_writes_tail_chunk(self):
+        state_tbl = utils.CountingTable(self.state_tbl)
+        state_list = s.StateList(None, state_tbl, s.ConvState, chunk_size=4)
+        for i in range(10):
+            state_list.append(s.ConvState(str(i), extractors=[]))
+        state_list.save(state_tbl)
+        self.assertEqual(len(state_tbl.puts), 14)
+
+        state_tbl.puts = []
+        state_list = s.StateList.load(state_list.id, state_tbl, s.ConvState)
+        self.assertEqual(state_list[5].question, "5")
+        new_state = s.ConvState("10", extractors=[])
+        state_list.append(new_state)
+        state_list.repeat_last()
+        state_list.save(state_tbl)
+        self.assertCountEqual(state_tbl.puts, [state_list.id,
+                                               state_list.chunk_id(2),
+                                               new_state.id])
+        self.assertEqual(len(state_list), 12)
+        self.assertEqual(state_list[-2], state_list[-1])
+
+    def test_repeats_are_run_length_encoded(self):
+        state_list = s.StateList(None, self.state_tbl, s.ConvState)
+        first = s.ConvState("first", extractors=[])
+        state_list.append(first)
+        for i in range(100):
+            state_list.repeat_last()
+        state_list.append(s.ConvState("second", extractors=[]))
+        state_list.save(self.state_tbl)
+
+        state_list = s.StateList.load(state_list.id, self.state_tbl,
+                                      s.ConvState)
+        self.assertEqual(len(state_list), 102)
+        self.assertEqual(state_list.runs[0], [first.id, 101])
+        self.assertEqual(len(state_list.runs), 2)
+        self.assertEqual(state_list[100].question, "first")
+        self.assertEqual(state_list[101].question, "second")
+        self.assertIn(first, state_list)
+
+    def test_loads_unchunked_state_ids(self):
+        state_ids = [state.id for state in self.state_list]
+        self.state_tbl.put_item(Item={'id': 'unchunked',
+                                      'state_ids': state_ids})
+        state_list = s.StateList.load('unchunked', self.state_tbl,
+                                      s.ConvState)
+        self.assertEqual(len(state_list), 150)
+        self.assertEqual(state_list[-1].question, "149")
+        state_list.save(self.state_tbl)
+        state_list = s.StateList.load('unchunked', self.state_tbl,
+                                      s.ConvState)
+        self.assertEqual(state_list.state_ids, state_ids)
+
+    def test_prefetch_last(self):
+        self.state_list.prefetch_last(3)
+        self.assertEqual(len(self.state_list.states), 3)
+        self.assertEqual(self.state_list[-3].question, "147")
+
+    def test_iter_fetches_in_pages(self):
+        questions = [state.question for state in self.state_list]
+        self.assertEqual(questions, [str(i) for i in range(150)])
+        self.assertEqual(len(self.state_list.states), 150)
+
 
 class TestConvState(unittest.TestCase):
 
@@ -276,6 +422,1037 @@ class TestStateExtractors(unittest.TestCase):
         self.user_extractor_util(test_cases)
 
 
+class TestExtractorRegistry(unittest.TestCase):
+
+    def test_register_and_unregister(self):
+
+        class TestExtractor(se.StateExtractor):
+            instances = 0
+
+            def __init__(self):
+                TestExtractor.instances += 1
+
+            type = "test"
+            state_var_names = ["test_var"]
+
+        self.addCleanup(se.registry.unregister, TestExtractor)
+        extractors = se.StateExtractor.get_extractors("test")
+        self.assertEqual([type(ext) for ext in extractors], [TestExtractor])
+        self.assertIs(se.StateExtractor.get_extractors("test")[0],
+                      extractors[0])
+        self.assertEqual(TestExtractor.instances, 1)
+
+        se.registry.unregister(TestExtractor)
+        self.assertEqual(se.StateExtractor.get_extractors("test"), ())
+        se.registry.register(TestExtractor)
+        self.assertEqual(len(se.StateExtractor.get_extractors("test")), 1)
+
+
+class TestExtractorRunner(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        setUpDynamo(cls)
+        cls.runner = runner.ExtractorRunner(max_workers=4)
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.runner.shutdown()
+
+    def setUp(self):
+        self.history = h.ConvHistory("runner_sessionid", self.state_tbl,
+                                     "convid", "userid")
+
+    def test_runs_concurrently_in_order(self):
+        exts = [utils.SleepyExtractor("first", 1, delay=0.2),
+                utils.SleepyExtractor("second", 2, delay=0.1),
+                utils.SleepyExtractor("third", 3, delay=0.2)]
+        state = s.ConvState("hello", exts)
+        start = time.monotonic()
+        self.assertTrue(self.runner.run(exts, state, self.history))
+        self.assertLess(time.monotonic() - start, 0.4)
+        self.assertEqual([getattr(state, var) for var in state.savers][-3:],
+                         [1, 2, 3])
+
+    def test_runs_cheap_extractors_inline(self):
+        cheap = [utils.SleepyExtractor(var, 1) for var in ("first", "second")]
+        state = s.ConvState("hello", cheap)
+        self.runner.run(cheap, state, self.history)
+        slow = utils.SleepyExtractor("slow", 2, delay=0.01)
+        exts = cheap + [slow]
+        state = s.ConvState("hello", exts)
+        self.runner.run(exts, state, self.history)
+        for ext in cheap:
+            self.assertEqual(ext.threads, [threading.current_thread()] * 2)
+        self.assertIsNot(slow.threads[0], threading.current_thread())
+        self.assertEqual((state.first, state.second, state.slow), (1, 1, 2))
+
+    def test_timeout_carries_last_value(self):
+        last = s.ConvState("hello", [utils.SleepyExtractor("slow", "old")])
+        last.run_extractors(self.history)
+        exts = [utils.SleepyExtractor("slow", "new", delay=0.5, timeout=0.05),
+                utils.SleepyExtractor("fast", "new")]
+        state = s.ConvState("hello again", exts)
+        self.runner.run(exts, state, self.history)
+        self.assertEqual(state.slow, "old")
+        self.assertEqual(state.fast, "new")
+
+    def test_runs_dependencies_first(self):
+        upper = utils.SleepyExtractor("upper", str.upper, delay=0.1,
+                                      inputs=["question"])
+        shout = utils.SleepyExtractor("shout", lambda text: text + "!",
+                                      inputs=["upper"])
+        state = s.ConvState("hello", [shout, upper])
+        self.runner.run(state.extractors, state, self.history)
+        self.assertEqual(state.shout, "HELLO!")
+
+    def test_skips_unchanged_inputs(self):
+        upper = utils.SleepyExtractor("upper", str.upper, inputs=["question"])
+        for question in ["hello", "hello", "bye"]:
+            s.ConvState(question, [upper]).run_extractors(self.history)
+        self.assertEqual(upper.calls, 2)
+        self.assertEqual(self.history.state_list[-2].upper, "HELLO")
+        self.assertEqual(self.history.state_list[-1].upper, "BYE")
+
+    def test_detects_cycles(self):
+        first = utils.SleepyExtractor("first", 1, inputs=["second"])
+        second = utils.SleepyExtractor("second", 2, inputs=["first"])
+        self.assertRaises(ValueError, runner.ExtractorGraph, [first, second])
+
+
+class TestMatchers(unittest.TestCase):
+
+    def test_PhraseMatcher(self):
+        matcher = matchers.PhraseMatcher(["he", "she", "hers", "dead body"])
+        self.assertTrue(matcher.search("ushers"))
+        self.assertTrue(matcher.search("there is a dead body"))
+        self.assertFalse(matcher.search("dead bod"))
+        self.assertFalse(matcher.search(""))
+
+    def test_WordMatcher(self):
+        matcher = matchers.WordMatcher(["ass", "xx"])
+        self.assertTrue(matcher.search(["you", "ass"]))
+        self.assertTrue(matcher.search(["xxx"]))
+        self.assertTrue(matcher.search(["assass"]))
+        self.assertFalse(matcher.search(["class", "assets"]))
+
+    def test_contains_profanity(self):
+        detector = se.ProfanityDetector()
+        self.assertTrue(detector.contains_profanity("Fuck you."))
+        self.assertTrue(detector.contains_profanity("you son of a bitch"))
+        self.assertFalse(detector.contains_profanity("you are class"))
+        self.assertFalse(detector.contains_profanity("Son of a gun"))
+
+
+class TestWriteBatch(unittest.TestCase):
+
+    def test_batches_and_coalesces_puts(self):
+        client = utils.BatchClient()
+        table = utils.BatchTable('test_states', client)
+        with core.WriteBatch():
+            for i in range(30):
+                core.put_item(table, {'id': str(i), 'value': 0})
+            core.put_item(table, {'id': '0', 'value': 1})
+        self.assertEqual([len(r['test_states']) for r in client.requests],
+                         [25, 5])
+        last_put = client.requests[-1]['test_states'][-1]['PutRequest']
+        self.assertEqual(last_put['Item'], {'id': '0', 'value': 1})
+
+    def test_retries_unprocessed_items(self):
+        client = utils.BatchClient(unprocessed=2)
+        table = utils.BatchTable('test_states', client)
+        with core.WriteBatch(backoff=0):
+            for i in range(3):
+                core.put_item(table, {'id': str(i)})
+        self.assertEqual(len(client.requests), 2)
+        self.assertEqual(len(client.requests[1]['test_states']), 2)
+
+
+class TestWriteBehindQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.client = utils.BatchClient()
+        self.table = utils.BatchTable('test_states', self.client)
+
+    def test_flush_coalesces_writes(self):
+        queue = write_behind.WriteBehindQueue(flush_interval=60)
+        self.addCleanup(queue.close)
+        item = {'id': '1', 'value': 0}
+        queue.put(core.Write(self.table, item))
+        item['value'] = 1
+        queue.put(core.Write(self.table, item))
+        self.assertEqual(self.client.requests, [])
+        self.assertTrue(queue.flush())
+        self.assertEqual(self.client.requests, [
+            {'test_states': [{'PutRequest': {'Item': {'id': '1', 'value': 1}}}]}
+        ])
+
+    def test_flushes_on_size_and_time(self):
+        queue = write_behind.WriteBehindQueue(flush_size=2, flush_interval=0.05)
+        self.addCleanup(queue.close)
+        queue.put(core.Write(self.table, {'id': '1'}))
+        queue.put(core.Write(self.table, {'id': '2'}))
+        time.sleep(0.02)
+        self.assertEqual(len(self.client.requests), 1)
+        queue.put(core.Write(self.table, {'id': '3'}))
+        time.sleep(0.2)
+        self.assertEqual(len(self.client.requests), 2)
+
+    def test_drops_writes_that_keep_failing(self):
+        self.client.failing = True
+        queue = write_behind.WriteBehindQueue(flush_interval=0.01,
+                                              max_attempts=3)
+        self.addCleanup(queue.close)
+        with self.assertLogs('eig_state.write_behind', 'ERROR'):
+            queue.put(core.Write(self.table, {'id': '1'}))
+            self.assertTrue(queue.flush(5))
+        self.assertEqual(len(self.client.requests), 3)
+        self.assertEqual([write.item for write in queue.dead_letters],
+                         [{'id': '1'}])
+
+    def test_set_response_writes_behind(self):
+        dynamo = local.LocalDynamo()
+        queue = write_behind.WriteBehindQueue(flush_interval=60)
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=dynamo, write_behind=queue)
+        sm.next_round("hello")
+        sm.set_response("hi there")
+        self.assertGreater(len(queue), 0)
+        queue.close()
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=dynamo)
+        self.assertEqual(sm.conv_history.state_list[-1].response, "hi there")
+
+
+class TestVersionedWrites(unittest.TestCase):
+
+    def setUp(self):
+        self.state_tbl = local.LocalDynamo().Table('states')
+        state_list = s.StateList(None, self.state_tbl, s.ConvState)
+        state_list.append(s.ConvState("first", extractors=[]))
+        state_list.save(self.state_tbl)
+        self.list_id = state_list.id
+
+    def load(self):
+        return s.StateList.load(self.list_id, self.state_tbl, s.ConvState)
+
+    def test_concurrent_appends_are_merged(self):
+        ours, theirs = self.load(), self.load()
+        theirs.append(s.ConvState("theirs", extractors=[]))
+        theirs.save(self.state_tbl)
+        ours.append(s.ConvState("ours", extractors=[]))
+        ours.save(self.state_tbl)
+        state_list = self.load()
+        self.assertEqual([state.question for state in state_list],
+                         ["first", "theirs", "ours"])
+        self.assertEqual(state_list.version, 3)
+
+    def test_concurrent_rewrite_raises(self):
+        ours, theirs = self.load(), self.load()
+        theirs.append(s.ConvState("theirs", extractors=[]))
+        theirs.save(self.state_tbl)
+        ours[0] = s.ConvState("ours", extractors=[])
+        self.assertRaises(core.ConflictError, ours.save, self.state_tbl)
+
+    def test_concurrently_created_histories_share_state_list(self):
+        conv_tbl = local.LocalDynamo().Table('conversations')
+        first = h.ConvHistory("race", self.state_tbl, "convid", "userid")
+        second = h.ConvHistory("race", self.state_tbl, "convid", "userid")
+        first.save(conv_tbl)
+        s.ConvState("hello", extractors=[]).run_extractors(second)
+        second.save(conv_tbl)
+        self.assertEqual(second.state_list_id, first.state_list_id)
+        item = conv_tbl.get_item(Key={'id': "race"})['Item']
+        state_list = s.StateList.load(item['state_list_id'], self.state_tbl,
+                                      s.ConvState)
+        self.assertEqual(state_list[-1].question, "hello")
+
+    def test_write_behind_conflict_is_redone_on_next_save(self):
+        ours, theirs = self.load(), self.load()
+        theirs.append(s.ConvState("theirs", extractors=[]))
+        theirs.save(self.state_tbl)
+        queue = write_behind.WriteBehindQueue(flush_interval=60)
+        self.addCleanup(queue.close)
+        ours.append(s.ConvState("ours", extractors=[]))
+        with core.WriteBatch(queue=queue):
+            ours.save(self.state_tbl)
+        queue.flush()
+        self.assertEqual(len(self.load()), 2)
+        ours.save(self.state_tbl)
+        self.assertEqual([state.question for state in self.load()],
+                         ["first", "theirs", "ours"])
+
+    def test_writes_of_different_owners_are_not_coalesced(self):
+        ours, theirs = self.load(), self.load()
+        queue = write_behind.WriteBehindQueue(flush_interval=60)
+        self.addCleanup(queue.close)
+        with core.WriteBatch(queue=queue):
+            theirs.append(s.ConvState("theirs", extractors=[]))
+            theirs.save(self.state_tbl)
+            ours.append(s.ConvState("ours", extractors=[]))
+            ours.save(self.state_tbl)
+        queue.flush()
+        ours.save(self.state_tbl)
+        queue.flush()
+        self.assertEqual([state.question for state in self.load()],
+                         ["first", "theirs", "ours"])
+
+    def test_batch_writes_different_owners_in_turn(self):
+        ours, theirs = self.load(), self.load()
+        with core.WriteBatch():
+            theirs.append(s.ConvState("theirs", extractors=[]))
+            theirs.save(self.state_tbl)
+            ours.append(s.ConvState("ours", extractors=[]))
+            ours.save(self.state_tbl)
+        self.assertEqual([state.question for state in self.load()],
+                         ["first", "theirs", "ours"])
+
+    def test_managers_sharing_a_queue_keep_both_turns(self):
+        dynamo = local.LocalDynamo()
+        queue = write_behind.WriteBehindQueue(flush_interval=60)
+        self.addCleanup(queue.close)
+        first = state_manager.StateManager("userid", "convid", "sessionid",
+                                           dynamo=dynamo, write_behind=queue)
+        first.next_round("q0")
+        first.set_response("r0")
+        queue.flush()
+        second = state_manager.StateManager("userid", "convid", "sessionid",
+                                            dynamo=dynamo, write_behind=queue)
+        first.next_round("qa")
+        first.set_response("ra")
+        second.next_round("qb")
+        second.set_response("rb")
+        queue.flush()
+        second.next_round("qc")
+        second.set_response("rc")
+        queue.flush()
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=dynamo)
+        questions = [state.question for state in sm.conv_history.state_list]
+        self.assertIn("qa", questions)
+        self.assertIn("qb", questions)
+
+
+class TestPartialSaves(unittest.TestCase):
+
+    def setUp(self):
+        self.state_tbl = utils.CountingTable(local.LocalDynamo().Table('states'))
+        state_list = s.StateList(None, self.state_tbl, s.ConvState)
+        state_list.append(s.ConvState("first", extractors=[]))
+        state_list.save(self.state_tbl)
+        self.state_list = s.StateList.load(state_list.id, self.state_tbl,
+                                           s.ConvState)
+        self.state_tbl.updates = []
+
+    def test_changed_attributes_are_set(self):
+        state = self.state_list[-1]
+        state.response = "hi"
+        state.register_saver('response')
+        state.save(self.state_tbl)
+        self.assertEqual(self.state_tbl.updates, ["SET response = :v0"])
+        item = self.state_tbl.get_item(Key={'id': state.id})['Item']
+        self.assertEqual(item['question'], "first")
+        self.assertEqual(item['response'], "hi")
+
+    def test_appends_are_list_appended(self):
+        self.state_list.append(s.ConvState("second", extractors=[]))
+        self.state_list.save(self.state_tbl)
+        self.state_list.repeat_last()
+        self.state_list.save(self.state_tbl)
+        self.assertEqual(self.state_tbl.updates, [
+            "SET length = :v0, chunk_lengths[0] = :v1, version = :v2",
+            "SET runs = list_append(runs, :v0)",
+            "SET length = :v0, chunk_lengths[0] = :v1, version = :v2",
+            "SET runs[1] = :v0",
+        ])
+        state_list = s.StateList.load(self.state_list.id, self.state_tbl,
+                                      s.ConvState)
+        self.assertEqual([state.question for state in state_list],
+                         ["first", "second", "second"])
+        self.assertEqual(state_list.runs[-1][1], 2)
+
+
+class TestStorage(unittest.TestCase):
+
+    def converse(self, storage, sessionid, question):
+        sm = state_manager.StateManager("userid", "convid", sessionid,
+                                        storage=storage)
+        sm.next_round(question)
+        sm.set_response(question.upper())
+        return sm
+
+    def test_memory_storage(self):
+        memory = storage.MemoryStorage()
+        self.converse(memory, "memory_sessionid", "hello")
+        sm = self.converse(memory, "memory_sessionid", "bye")
+        self.assertEqual([state.response for state in sm.conv_history.state_list],
+                         ["HELLO", "BYE"])
+
+    def test_memory_storage_makes_each_table_once(self):
+        interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, interval)
+        for attempt in range(50):
+            memory = storage.MemoryStorage()
+            barrier = threading.Barrier(8)
+            tables = []
+
+            def table():
+                barrier.wait()
+                tables.append(memory.resource.Table('users'))
+
+            threads = [threading.Thread(target=table) for _ in range(8)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertTrue(all(table is tables[0] for table in tables))
+
+    def test_storages_must_have_tables(self):
+        self.assertRaises(TypeError, storage.Storage)
+
+    def test_sqlite_storage_persists(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'state.db')
+        sqlite = storage.SQLiteStorage(path)
+        self.converse(sqlite, "sqlite_sessionid", "hello")
+        sqlite.close()
+
+        sqlite = storage.SQLiteStorage(path)
+        self.addCleanup(sqlite.close)
+        sm = self.converse(sqlite, "sqlite_sessionid", "bye")
+        state_list = sm.conv_history.state_list
+        self.assertEqual([state.question for state in state_list],
+                         ["hello", "bye"])
+        self.assertEqual(state_list.version, 3)
+
+    def test_sqlite_storage_checks_versions(self):
+        sqlite = storage.SQLiteStorage()
+        self.addCleanup(sqlite.close)
+        table = sqlite.table('states')
+        table.put_item(Item={'id': '1', 'version': 1},
+                       **core.version_condition(0))
+        self.assertRaises(core.ConflictError, core.put_item, table,
+                          {'id': '1', 'version': 2}, expected_version=0)
+        core.put_item(table, {'id': '1'}, expected_version=1,
+                      actions=[(('runs',), [['a', 1]], False)])
+        self.assertEqual(table.get_item(Key={'id': '1'})['Item'],
+                         {'id': '1', 'version': 1, 'runs': [['a', 1]]})
+
+    def test_dynamo_pool_caps_connections_per_process(self):
+        dynamo_pool = pool.DynamoPool(max_connections=4)
+        client = dynamo_pool.table('states').meta.client
+        self.assertIs(dynamo_pool.resource().meta.client, client)
+        self.assertEqual(client.meta.config.max_pool_connections, 4)
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        class PackedState(s.ConvState):
+            codec = codec.Codec('json')
+        self.state_cls = PackedState
+        self.table = local.LocalDynamo().Table('states')
+        self.nes = {'entities': [{'text': "word {}".format(i), 'label': "NOUN"}
+                                 for i in range(50)]}
+
+    def test_saves_attributes_in_blob(self):
+        state = self.state_cls("hello", extractors=[])
+        state.nes = self.nes
+        state.register_saver('nes')
+        state.save(self.table)
+        item = self.table.get_item(Key={'id': state.id})['Item']
+        self.assertEqual(set(item), {'id', 'blob'})
+        self.assertLess(core.item_size(item),
+                        core.item_size({'question': "hello", 'nes': self.nes}))
+        loaded = s.ConvState.from_dict(item)
+        self.assertEqual(loaded.id, state.id)
+        self.assertEqual(loaded.nes, self.nes)
+        self.assertEqual(loaded.question, "hello")
+
+    def test_small_payloads_are_not_compressed(self):
+        packed = codec.Codec('json', min_size=1000).pack({'id': '1', 'a': 1})
+        self.assertEqual(packed['blob'], b'E\x01\x00{"a":1}')
+        self.assertEqual(codec.unpack(packed), {'id': '1', 'a': 1})
+
+    def test_old_items_still_load(self):
+        self.table.put_item(Item={'id': 'old', 'question': "hello",
+                                  'nes': self.nes})
+        item = self.table.get_item(Key={'id': 'old'})['Item']
+        state = self.state_cls.from_dict(item)
+        self.assertEqual(state.nes, self.nes)
+        state.response = "hi"
+        state.register_saver('response')
+        state.save(self.table)
+        item = self.table.get_item(Key={'id': 'old'})['Item']
+        self.assertEqual(set(item), {'id', 'blob'})
+        loaded = s.ConvState.from_dict(item)
+        self.assertEqual(loaded.response, "hi")
+        self.assertEqual(loaded.nes, self.nes)
+
+    def test_packed_items_keep_loaded_attributes(self):
+        state = self.state_cls("hello", extractors=[])
+        state.nes = self.nes
+        state.has_swear = False
+        state.register_saver('nes')
+        state.register_saver('has_swear')
+        state.save(self.table)
+        item = self.table.get_item(Key={'id': state.id})['Item']
+        state = self.state_cls.from_dict(item)
+        state.response = "hi"
+        state.register_saver('response')
+        state.save(self.table)
+        item = self.table.get_item(Key={'id': state.id})['Item']
+        loaded = s.ConvState.from_dict(item)
+        self.assertEqual((loaded.question, loaded.response), ("hello", "hi"))
+        self.assertEqual(loaded.nes, self.nes)
+        self.assertFalse(loaded.has_swear)
+
+    def test_unknown_format_version_raises(self):
+        self.assertRaises(ValueError, codec.unpack,
+                          {'id': '1', 'blob': b'E\x09\x00{}'})
+
+    @unittest.skipIf(codec.msgpack is None, "msgpack isn't installed")
+    def test_msgpack(self):
+        packer = codec.Codec('msgpack')
+        item = {'id': '1', 'version': 2, 'nes': self.nes}
+        self.assertEqual(codec.unpack(packer.pack(item)), item)
+
+    def test_state_manager_packs_states(self):
+        packer = codec.Codec('json')
+        for compact in (False, True):
+            dynamo = local.LocalDynamo()
+            sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                            dynamo=dynamo, codec=packer,
+                                            compact=compact)
+            self.assertIs(sm.conv_state_cls.codec, packer)
+            sm.next_round("hello")
+            sm.set_response("hi there")
+            state = sm.conv_history.state_list[-1]
+            item = dynamo.Table('states').get_item(Key={'id': state.id})['Item']
+            self.assertEqual(set(item), {'id', 'blob'})
+
+            sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                            dynamo=dynamo, codec=packer,
+                                            compact=compact)
+            last = sm.conv_history.state_list[-1]
+            self.assertEqual((last.question, last.response), ("hello", "hi there"))
+            self.assertEqual(last.has_swear, state.has_swear)
+            sm.next_round("bye")
+            sm.set_response("see you")
+            self.assertEqual(len(sm.conv_history.state_list), 2)
+
+    def test_sqlite_storage_keeps_blobs(self):
+        sqlite = storage.SQLiteStorage()
+        self.addCleanup(sqlite.close)
+        table = sqlite.table('states')
+        state = self.state_cls("hello", extractors=[])
+        state.save(table)
+        item = table.get_item(Key={'id': state.id})['Item']
+        self.assertEqual(s.ConvState.from_dict(item).question, "hello")
+
+
+class TestFingerprints(unittest.TestCase):
+
+    def test_equal_values_have_equal_fingerprints(self):
+        self.assertEqual(core.fingerprint({'a': [1, 2], 'b': {3}}),
+                         core.fingerprint({'b': {3}, 'a': [decimal.Decimal(1), 2.0]}))
+        self.assertNotEqual(core.fingerprint([1, 2]), core.fingerprint([2, 1]))
+
+    def test_states_compare_and_hash_by_value(self):
+        nes = {'entities': [{'text': "word", 'label': "NOUN"}]}
+        for state_cls in (s.ConvState, s.ConvState.compact()):
+            last = state_cls("hello", extractors=None)
+            last.nes = nes
+            last.register_saver('nes')
+            state = state_cls("hello", extractors=None)
+            state.nes = nes
+            state.register_saver('nes')
+            self.assertEqual(state, last)
+            # one and the same value isn't walked
+            self.assertNotIn('nes', getattr(state, '_fingerprints', {}))
+            self.assertEqual(hash(state), hash(last))
+
+            state.nes = {'entities': [{'text': "word", 'label': "NOUN"}]}
+            self.assertEqual(state, last)
+            state.nes['entities'].append({'text': "other", 'label': "NOUN"})
+            state.mark_dirty('nes')
+            self.assertNotEqual(state, last)
+            self.assertNotEqual(hash(state), hash(last))
+
+    def test_colliding_fingerprints_are_told_apart(self):
+        for before, after in [(-1, -2), ({'n': -1}, {'n': -2}),
+                              ([(-1, "a")], [(-2, "a")])]:
+            self.assertEqual(core.fingerprint(before), core.fingerprint(after))
+            for state_cls in (s.ConvState, s.ConvState.compact()):
+                last = state_cls("hello", extractors=None)
+                last.nes = before
+                last.register_saver('nes')
+                state = state_cls("hello", extractors=None)
+                state.nes = after
+                state.register_saver('nes')
+                self.assertNotEqual(state, last)
+
+
+class TestCompactState(unittest.TestCase):
+
+    def setUp(self):
+        self.state_cls = s.ConvState.compact()
+        self.table = local.LocalDynamo().Table('states')
+
+    def test_fields_come_from_extractors(self):
+        self.assertIs(s.ConvState.compact(), self.state_cls)
+        self.assertEqual(self.state_cls.schema[:3], ('id', 'question', 'response'))
+        for extractor in se.registry.get("conv"):
+            for var in extractor.state_var_names:
+                self.assertIn(var, self.state_cls.schema)
+        state = self.state_cls("hello")
+        self.assertFalse(hasattr(state, '__dict__'))
+        self.assertRaises(AttributeError, setattr, state, 'unknown', 1)
+        self.assertRaises(ValueError, state.register_saver, 'unknown')
+
+    def test_saves_and_loads(self):
+        state = self.state_cls("hello")
+        state.has_swear = False
+        state.register_saver('has_swear')
+        state.save(self.table)
+        self.assertFalse(state.dirty)
+        item = self.table.get_item(Key={'id': state.id})['Item']
+        self.assertEqual(item, {'id': state.id, 'question': "hello",
+                                'has_swear': False})
+
+        loaded = self.state_cls.from_dict(item)
+        self.assertEqual(loaded, state)
+        self.assertEqual(s.ConvState.from_dict(item).question, "hello")
+        loaded.response = "hi"
+        loaded.register_saver('response')
+        self.assertEqual(loaded._dirty, {'response'})
+        loaded.save(self.table)
+        item = self.table.get_item(Key={'id': state.id})['Item']
+        self.assertEqual(item['response'], "hi")
+        self.assertFalse(item['has_swear'])
+
+    def test_keeps_unknown_attributes(self):
+        self.table.put_item(Item={'id': 'old', 'question': "hello",
+                                  'retired_var': 1})
+        item = self.table.get_item(Key={'id': 'old'})['Item']
+        state = self.state_cls.from_dict(item)
+        state.mark_dirty()
+        state.save(self.table)
+        item = self.table.get_item(Key={'id': 'old'})['Item']
+        self.assertEqual(item['retired_var'], 1)
+
+    def test_state_manager_rounds(self):
+        dynamo = local.LocalDynamo()
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=dynamo, compact=True)
+        sm.next_round("hello")
+        sm.set_response("hi there")
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=dynamo, compact=True)
+        last = sm.conv_history.state_list[-1]
+        self.assertIsInstance(last, self.state_cls)
+        self.assertEqual((last.question, last.response), ("hello", "hi there"))
+        sm.next_round("hello")
+        self.assertEqual(len(sm.conv_history.state_list), 2)
+
+
+class TestService(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = service.ManagerPool(storage=storage.MemoryStorage())
+        self.ids = {'userid': "userid", 'convid': "convid",
+                    'sessionid': "sessionid"}
+
+    def test_turns_share_managers(self):
+        result = service.run_turn(self.pool, dict(self.ids, question="hello"))
+        self.assertEqual(result['conv_state']['question'], "hello")
+        self.assertIn('user_state', result)
+        result = service.run_turn(self.pool, dict(self.ids, response="hi"))
+        self.assertEqual(result, {'saved': True})
+        self.assertEqual(len(self.pool), 1)
+
+        with self.pool.session("userid", "convid", "sessionid") as sm:
+            self.assertEqual(sm.conv_history.state_list[-1].response, "hi")
+        with self.assertRaises(service.TurnError) as raised:
+            service.run_turn(self.pool, dict(self.ids, response="hi"))
+        self.assertEqual(raised.exception.status, 409)
+
+    def test_unfinished_turn_times_out(self):
+        self.pool.turn_timeout = 0.05
+        service.run_turn(self.pool, dict(self.ids, question="hello", response="hi"))
+        service.run_turn(self.pool, dict(self.ids, question="lost"))
+        with self.assertRaises(service.TurnError) as raised:
+            service.run_turn(self.pool, dict(self.ids, question="again"))
+        self.assertEqual(raised.exception.status, 409)
+        time.sleep(0.1)
+        result = service.run_turn(self.pool, dict(self.ids, question="again",
+                                                  response="ok"))
+        self.assertTrue(result['saved'])
+        with self.pool.session("userid", "convid", "sessionid") as sm:
+            self.assertEqual([state.question for state in sm.conv_history.state_list],
+                             ["hello", "again"])
+
+    def test_sessions_of_one_user_take_turns(self):
+        memory = storage.MemoryStorage()
+        for name in ('states', 'users', 'conversations'):
+            memory.table(name)
+        self.pool = service.ManagerPool(storage=memory)
+        errors = []
+
+        def converse(session):
+            for i in range(20):
+                try:
+                    service.run_turn(self.pool, dict(
+                        self.ids, sessionid=str(session),
+                        question="q{}".format(i), response="r"))
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=converse, args=(session,))
+                   for session in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        sm = state_manager.StateManager("userid", "convid", "0",
+                                        storage=memory)
+        self.assertEqual(len(sm.user_history.state_list), 160)
+        self.assertEqual(len(sm.user_history.state_list.state_ids), 160)
+
+    def test_turn_order_errors(self):
+        with self.pool.session("userid", "convid", "sessionid") as sm:
+            self.assertRaises(state_manager.TurnOrderError, sm.set_response, "hi")
+            sm.next_round("hello")
+            self.assertRaises(state_manager.TurnOrderError, sm.next_round, "hello")
+            sm.discard_turn()
+            self.assertEqual(len(sm.conv_history.state_list), 0)
+            sm.next_round("hello")
+
+    def test_batch_reports_each_turn(self):
+        turns = [dict(self.ids, sessionid=str(i), question="hello",
+                      response="hi") for i in range(3)]
+        turns.append({'question': "hello"})
+        results = service.run_turns(self.pool, turns)
+        self.assertEqual([r.get('saved') for r in results[:3]], [True] * 3)
+        self.assertEqual(results[3]['status'], 400)
+        self.assertEqual(self.pool.stats()['managers'], 3)
+
+    def test_drops_idle_managers(self):
+        self.pool.max_managers = 2
+        for i in range(3):
+            service.run_turn(self.pool, dict(self.ids, sessionid=str(i),
+                                             question="hello", response="hi"))
+        self.assertEqual(len(self.pool), 2)
+        # the dropped session is reloaded from storage
+        result = service.run_turn(self.pool, dict(self.ids, sessionid="0",
+                                                  question="again"))
+        self.assertEqual(result['conv_state']['question'], "again")
+
+    def test_http_endpoints(self):
+        try:
+            import app
+        except ImportError:
+            self.skipTest("app.py isn't importable from here")
+        client = app.create_app(self.pool).test_client()
+        response = client.post('/next_round', json=dict(self.ids, question="hello"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_json()['conv_state']['question'], "hello")
+        response = client.post('/next_round', json=dict(self.ids, question="hello"))
+        self.assertEqual(response.status_code, 409)
+        response = client.post('/set_response', json=dict(self.ids, response="hi"))
+        self.assertEqual(response.get_json(), {'saved': True})
+        response = client.post('/batch', json={'turns': [
+            dict(self.ids, question="more", response="ok")]})
+        self.assertTrue(response.get_json()['results'][0]['saved'])
+        self.assertEqual(client.get('/health').get_json()['managers'], 1)
+
+
+class TestASGIService(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = write_behind.WriteBehindQueue(flush_interval=60)
+        self.storage = storage.MemoryStorage()
+        self.pool = service.ManagerPool(storage=self.storage,
+                                        write_behind=self.queue)
+        self.app = asgi.ASGIService(self.pool, concurrency=4)
+
+    async def request(self, method, path, body=None):
+        messages = [{'type': 'http.request',
+                     'body': b'' if body is None else json.dumps(body).encode()}]
+        sent = []
+
+        async def receive():
+            return messages.pop(0)
+
+        async def send(message):
+            sent.append(message)
+
+        await self.app({'type': 'http', 'method': method, 'path': path},
+                       receive, send)
+        return sent[0]['status'], json.loads(sent[1]['body'])
+
+    def test_serves_turns_and_drains_on_shutdown(self):
+        ids = {'userid': "userid", 'convid': "convid"}
+
+        async def serve():
+            results = await asyncio.gather(*[
+                self.request('POST', '/turns', dict(ids, sessionid=str(i),
+                                                    question="hello",
+                                                    response="hi"))
+                for i in range(4)])
+            self.assertEqual([r[0] for r in results], [200] * 4)
+            self.assertEqual((await self.request('GET', '/next_round'))[0], 405)
+            self.assertEqual((await self.request('POST', '/turns', [1]))[0], 400)
+            self.assertGreater(len(self.queue), 0)
+
+            messages = [{'type': 'lifespan.startup'},
+                        {'type': 'lifespan.shutdown'}]
+            sent = []
+
+            async def receive():
+                return messages.pop(0)
+
+            async def send(message):
+                sent.append(message['type'])
+
+            await self.app({'type': 'lifespan'}, receive, send)
+            self.assertEqual(sent, ['lifespan.startup.complete',
+                                    'lifespan.shutdown.complete'])
+            self.assertEqual((await self.request('POST', '/turns', {}))[0], 503)
+
+        asyncio.run(serve())
+        self.assertEqual(len(self.queue), 0)
+        item = self.storage.table('conversations').get_item(Key={'id': "0"})
+        self.assertIn('Item', item)
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.storage = storage.MemoryStorage()
+        self.pools = {node: sharding.ShardedManagerPool(
+            node, ["a", "b"], storage=self.storage)
+            for node in ("a", "b")}
+        for pool in self.pools.values():
+            self.addCleanup(pool.close)
+
+    def turn(self, userid, **turn):
+        return dict(turn, userid=userid, convid="convid",
+                    sessionid="session-" + userid)
+
+    def test_ring_moves_few_keys(self):
+        ring = sharding.HashRing(["a", "b", "c"])
+        keys = [str(i) for i in range(1000)]
+        before = {key: ring.owner(key) for key in keys}
+        self.assertEqual(set(before.values()), {"a", "b", "c"})
+        ring.add("d")
+        moved = [key for key in keys if ring.owner(key) != before[key]]
+        self.assertTrue(all(ring.owner(key) == "d" for key in moved))
+        self.assertLess(len(moved), 400)
+        ring.remove("d")
+        self.assertEqual({key: ring.owner(key) for key in keys}, before)
+
+    def test_refuses_sessions_owned_elsewhere(self):
+        owner = self.pools["a"].owner("user", "convid", "session-user")
+        other = "b" if owner == "a" else "a"
+        with self.assertRaises(sharding.NotOwnerError) as raised:
+            service.run_turn(self.pools[other], self.turn("user", question="hello"))
+        self.assertEqual(raised.exception.owner, owner)
+        status, payload = service.handle(self.pools[other], 'POST', '/turns',
+                                         self.turn("user", question="hello"))
+        self.assertEqual((status, payload['owner']), (421, owner))
+        result = service.run_turn(self.pools[owner],
+                                  self.turn("user", question="hello", response="hi"))
+        self.assertTrue(result['saved'])
+
+    def test_hands_off_when_nodes_leave(self):
+        users = [str(i) for i in range(20)]
+        for user in users:
+            pool = self.pools[self.pools["a"].owner(user, "convid", "session-" + user)]
+            service.run_turn(pool, self.turn(user, question="hello", response="hi"))
+        moved = [user for user in users
+                 if self.pools["b"].owner(user, "convid", "session-" + user) == "b"]
+        self.assertTrue(moved)
+
+        released = self.pools["b"].set_nodes(["a"])
+        self.assertEqual(sorted(key[0] for key in released), sorted(moved))
+        self.assertEqual(len(self.pools["b"]), 0)
+        self.pools["a"].set_nodes(["a"])
+        for user in moved:
+            result = service.run_turn(self.pools["a"], self.turn(user, question="again"))
+            self.assertEqual(result['conv_state']['question'], "again")
+            with self.pools["a"].session(user, "convid", "session-" + user) as sm:
+                self.assertEqual(len(sm.conv_history.state_list), 2)
+
+    def test_handoff_stops_waiting_for_failing_writes(self):
+        pool = self.pools["a"]
+        pool.handoff_timeout = 0.1
+        queue = pool.manager_kwargs['write_behind']
+        queue.flush_interval = 0.01
+        queue.max_attempts = 1000
+        table = utils.BatchTable('states', utils.BatchClient(failing=True))
+        queue.put(core.Write(table, {'id': '1'}))
+        start = time.monotonic()
+        with self.assertLogs('eig_state.sharding', 'WARNING'):
+            status, payload = service.handle(pool, 'POST', '/nodes',
+                                             {'nodes': ["a"]})
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual((status, payload['pending_writes']), (200, 1))
+        queue.max_attempts = 1
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        metrics.registry.reset()
+        metrics.registry.enabled = True
+        self.addCleanup(setattr, metrics.registry, 'enabled', False)
+        self.addCleanup(metrics.registry.reset)
+
+    def recorded(self, name, **labels):
+        snapshot = metrics.registry.snapshot()
+        return [entry for entry in snapshot['histograms'] + snapshot['counters']
+                if entry['name'] == name and
+                all(entry['labels'].get(k) == v for k, v in labels.items())]
+
+    def test_disabled_records_nothing(self):
+        registry = metrics.Metrics(enabled=False)
+        self.assertIs(registry.span('x'), metrics.NULL_SPAN)
+        with registry.span('x'):
+            registry.count('y')
+        self.assertEqual(registry.snapshot(), {'histograms': [], 'counters': []})
+
+    def test_turn_spans_and_dynamo_counters(self):
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=local.LocalDynamo())
+        sm.next_round("hello")
+        sm.set_response("hi there")
+        for name in ('eig_state_history_load_seconds',
+                     'eig_state_history_save_seconds'):
+            self.assertEqual(len(self.recorded(name)), 2)
+        self.assertEqual(self.recorded('eig_state_turn_seconds',
+                                       step='set_response')[0]['count'], 1)
+        for extractor in se.registry.get("conv"):
+            self.assertTrue(self.recorded('eig_state_extractor_seconds',
+                                          extractor=type(extractor).__name__))
+        gets = self.recorded('eig_state_dynamo_calls_total', operation='get_item')
+        self.assertEqual(gets[0]['value'], 2)
+        sent = self.recorded('eig_state_dynamo_bytes_total', direction='sent')
+        self.assertGreater(sum(entry['value'] for entry in sent), 0)
+
+        text = metrics.registry.render()
+        self.assertIn('# TYPE eig_state_turn_seconds histogram', text)
+        self.assertIn('eig_state_turn_seconds_bucket{step="next_round",le="+Inf"} 1',
+                      text)
+        self.assertIn('eig_state_dynamo_calls_total{operation="get_item"} 2', text)
+
+    def test_spans_log_json_at_debug(self):
+        with self.assertLogs('eig_state.metrics', 'DEBUG') as logs:
+            with metrics.registry.span('eig_state_test_seconds', kind="a"):
+                pass
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual((record['span'], record['kind']),
+                         ('eig_state_test_seconds', "a"))
+
+
+class TestBenchmark(unittest.TestCase):
+
+    def test_runs_and_compares(self):
+        results = benchmark.run(quick=True, repeat=3)
+        names = set(results['results'])
+        self.assertIn('contains_profanity/500_words', names)
+        self.assertIn('run_extractors/conv', names)
+        self.assertIn('run_extractors/user', names)
+        self.assertIn('state_list/save/10000', names)
+        self.assertIn('cycle/next_round+set_response', names)
+        for name, result in results['results'].items():
+            self.assertLessEqual(result['p50'], result['p99'])
+            if name.startswith('state_list/'):
+                self.assertGreaterEqual(result['calls'], benchmark.BLOCKS)
+        json.dumps(results)
+
+        baseline = copy.deepcopy(results)
+        self.assertEqual(benchmark.compare(results, baseline), [])
+        baseline['results']['run_extractors/conv']['p50'] /= 10
+        self.assertEqual([r[0] for r in benchmark.compare(results, baseline)],
+                         ['run_extractors/conv'])
+
+
+class TestHistoryCache(unittest.TestCase):
+
+    def setUp(self):
+        self.dynamo = local.LocalDynamo()
+        self.cache = cache.HistoryCache()
+
+    def state_manager(self, sessionid="sessionid"):
+        return state_manager.StateManager("userid", "convid", sessionid,
+                                          dynamo=self.dynamo, cache=self.cache)
+
+    def test_reuses_histories_between_turns(self):
+        sm = self.state_manager()
+        sm.next_round("hello")
+        sm.set_response("hi there")
+        self.assertEqual(self.cache.stats()['misses'], 2)
+
+        next_sm = self.state_manager()
+        self.assertIs(next_sm.conv_history, sm.conv_history)
+        self.assertIs(next_sm.user_history, sm.user_history)
+        self.assertEqual(self.cache.stats()['hits'], 2)
+
+    def test_managers_of_one_user_share_its_history_safely(self):
+        managers = [self.state_manager(str(i)) for i in range(8)]
+        self.assertTrue(all(sm.user_history is managers[0].user_history
+                            for sm in managers))
+        errors = []
+
+        def converse(sm):
+            for i in range(40):
+                try:
+                    sm.next_round("q{}".format(i))
+                    sm.set_response("r")
+                except Exception as e:
+                    errors.append(e)
+
+        threads = [threading.Thread(target=converse, args=(sm,))
+                   for sm in managers]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+        sm = state_manager.StateManager("userid", "convid", "0",
+                                        dynamo=self.dynamo)
+        self.assertEqual(len(sm.user_history.state_list), 320)
+
+    def test_evicts_least_recently_used(self):
+        self.cache.max_entries = 2
+        self.state_manager("first")
+        self.state_manager("second")
+        self.assertEqual(len(self.cache), 2)
+        self.assertIsNone(self.cache.get('conversations', 'first'))
+        self.assertEqual(self.cache.evictions, 1)
+
+        self.cache.max_bytes = 0
+        self.state_manager("third")
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expires_and_invalidates(self):
+        sm = self.state_manager()
+        self.cache.invalidate('conversations', 'sessionid')
+        self.assertIsNone(self.cache.get('conversations', 'sessionid'))
+        self.cache.ttl = 0
+        self.assertIsNone(self.cache.get('users', 'userid'))
+        self.assertEqual(self.cache.stats()['entries'], 0)
+
+    def test_entries_expire_by_default(self):
+        self.assertIsNotNone(cache.HistoryCache().ttl)
+        self.assertIsNotNone(service.ManagerPool(
+            storage=storage.MemoryStorage()).cache.ttl)
+
+
 class TestStateManager(unittest.TestCase):
 
     @classmethod
@@ -297,6 +1474,22 @@ class TestStateManager(unittest.TestCase):
                               boto3.resources.base.ServiceResource)
         self.assertEqual(self.sm.dynamo.meta.service_name, 'dynamodb')
 
+    def test_sm_reuses_pooled_tables(self):
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        state_tbl_name='test_states',
+                                        user_tbl_name='test_users',
+                                        conv_tbl_name='test_conversations')
+        self.assertIs(sm.dynamo, self.sm.dynamo)
+        self.assertIs(sm.get_table('test_states'),
+                      self.sm.get_table('test_states'))
+
+        tables = []
+        thread = threading.Thread(
+            target=lambda: tables.append(sm.get_table('test_states')))
+        thread.start()
+        thread.join()
+        self.assertIs(tables[0], sm.get_table('test_states'))
+
     def test_sm_can_write_to_dynamo(self):
         test_item = {'id': '1', 'test_field':'test'}
         tbl = self.sm.get_table(self.sm.conv_tbl_name)
@@ -340,3 +1533,45 @@ class TestStateManager(unittest.TestCase):
 
         self.assertIsInstance(user_history.state_list[-2], s.UserState)
 
+    def test_lazy_history_loads_window(self):
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        state_tbl_name='test_states',
+                                        user_tbl_name='test_users',
+                                        conv_tbl_name='test_conversations',
+                                        window=1)
+        self.assertIsNone(sm.conv_history._state_list)
+        self.assertEqual(len(sm.conv_history.state_list.states), 1)
+        self.assertEqual(sm.conv_history.state_list[-1].response,
+                         self.test_res)
+
+
+class TestAsyncStateManager(unittest.TestCase):
+
+    def setUp(self):
+        self.dynamo = local.LocalDynamo()
+
+    async def converse(self, sessionid, question, response):
+        sm = await aio.AsyncStateManager.create("userid", "convid", sessionid,
+                                                dynamo=self.dynamo)
+        await sm.next_round(question)
+        await sm.set_response(response)
+        return sm
+
+    def test_next_round_and_set_response(self):
+        asyncio.run(self.converse("sessionid", "hello", "hi there"))
+        sm = asyncio.run(self.converse("sessionid", "who are you?", "eigen"))
+        self.assertEqual(sm.conv_history.state_list[-2].question, "hello")
+
+        sm = state_manager.StateManager("userid", "convid", "sessionid",
+                                        dynamo=self.dynamo)
+        self.assertEqual(len(sm.conv_history.state_list), 2)
+        self.assertEqual(sm.conv_history.state_list[-1].response, "eigen")
+
+    def test_serves_conversations_concurrently(self):
+        async def converse_all():
+            return await asyncio.gather(*[
+                self.converse("session{}".format(i), "hello", str(i))
+                for i in range(5)])
+        managers = asyncio.run(converse_all())
+        self.assertEqual([sm.conv_history.state_list[-1].response
+                          for sm in managers], [str(i) for i in range(5)])
@@ -1,3 +1,6 @@
+import threading
+import time
+
 from eig_state import state_extractors as se
 
 def test_runs_conv_extractors(test_case, test_state):
@@ -14,3 +17,116 @@ def test_runs_extractors(test_case, test_state, extractor_type):
                                  msg="Extractor {} missing state var {}"
                                  .format(extractor.__class__.__name__, name))
             test_case.assertTrue(name in test_state.savers)
+
+class CountingTable:
+    """
+    Wraps a dynamodb table and records the ids of the items written to it,
+    and the update expressions used, with names in place of placeholders
+    """
+
+    def __init__(self, table):
+        self.table = table
+        self.puts = []
+        self.updates = []
+        self.meta = type('Meta', (), {'client': CountingClient(self)})
+
+    def put_item(self, Item, **kwargs):
+        self.puts.append(Item['id'])
+        return self.table.put_item(Item=Item, **kwargs)
+
+    def update_item(self, Key, **kwargs):
+        self.puts.append(Key['id'])
+        self.record(kwargs)
+        return self.table.update_item(Key=Key, **kwargs)
+
+    def record(self, update):
+        expression = update['UpdateExpression']
+        for placeholder, name in update['ExpressionAttributeNames'].items():
+            expression = expression.replace(placeholder, name)
+        self.updates.append(expression)
+
+    def __getattr__(self, name):
+        return getattr(self.table, name)
+
+class CountingClient:
+    """
+    Client of a CountingTable, recording the items written in transactions
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def transact_write_items(self, TransactItems):
+        for request in TransactItems:
+            if 'Put' in request:
+                self.table.puts.append(request['Put']['Item']['id'])
+            else:
+                self.table.puts.append(request['Update']['Key']['id'])
+                self.table.record(request['Update'])
+        return self.table.table.meta.client.transact_write_items(
+            TransactItems=TransactItems)
+
+    def __getattr__(self, name):
+        return getattr(self.table.table.meta.client, name)
+
+class BatchClient:
+    """
+    Stands in for a dynamodb client, recording batch_write_item requests and
+    leaving the first `unprocessed` items of each table unprocessed once, or
+    failing every request while `failing` is set
+    """
+
+    def __init__(self, unprocessed=0, failing=False):
+        self.requests = []
+        self.unprocessed = unprocessed
+        self.failing = failing
+
+    def batch_write_item(self, RequestItems):
+        self.requests.append(RequestItems)
+        if self.failing:
+            raise ConnectionError("DynamoDB is unreachable")
+        unprocessed = {}
+        if self.unprocessed:
+            for name, writes in RequestItems.items():
+                unprocessed[name] = writes[:self.unprocessed]
+            self.unprocessed = 0
+        return {'UnprocessedItems': unprocessed}
+
+class BatchTable:
+
+    def __init__(self, name, client):
+        self.name = name
+        self.meta = type('Meta', (), {'client': client})
+
+class SleepyExtractor:
+    """
+    Conv extractor that sleeps for delay seconds before setting var to value,
+    or to value applied to its inputs if value is callable. It is slow if it
+    sleeps, and records the threads it ran on.
+    """
+
+    def __init__(self, var, value, delay=0, timeout=None, inputs=None):
+        self.var = var
+        self.value = value
+        self.delay = delay
+        self.slow = delay > 0
+        self.timeout = timeout
+        self.input_var_names = inputs
+        self.calls = 0
+        self.threads = []
+
+    @property
+    def state_var_names(self):
+        return [self.var]
+
+    def __call__(self, state, history):
+        self.calls += 1
+        self.threads.append(threading.current_thread())
+        time.sleep(self.delay)
+        value = self.value
+        if callable(value):
+            value = value(*[getattr(state, var)
+                            for var in self.input_var_names])
+        state.register_saver(self.var)
+        setattr(state, self.var, value)
+        return True
@@ -0,0 +1,177 @@
+import collections
+import logging
+import threading
+import time
+from eig_state.core import WriteBatch
+
+logger = logging.getLogger(__name__)
+
+
+class WriteBehindQueue:
+    """
+    Writes saved items to dynamodb from a background thread, so callers
+    don't wait on the writes.
+
+    Items are snapshotted when they are queued and coalesced by table, id
+    and the object they were saved from, so an object saved several times
+    before a flush is written once; saves of one item by different objects
+    are written in the order they came. The flusher writes everything
+    pending through a WriteBatch once flush_size items are queued or the
+    oldest one has waited flush_interval seconds. Items that fail to write
+    are queued again, up to max_attempts flushes, after which they are
+    logged and dropped into dead_letters (which keeps the last
+    max_dead_letters) and their object is marked stale, so that it writes
+    them again when it is next saved. flush() blocks until all items
+    queued so far are written or dropped and close() flushes and stops
+    the thread.
+
+    A versioned write that loses to another writer is dropped, along with
+    any later write of the same object, and the object is marked stale: its
+    next save refreshes it and writes everything it still has to.
+    """
+
+    def __init__(self, flush_size=25, flush_interval=0.5, max_retries=8,
+                 backoff=0.05, max_attempts=10, max_dead_letters=1000):
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_attempts = max_attempts
+        self.dead_letters = collections.deque(maxlen=max_dead_letters)
+        self._pending = collections.OrderedDict()
+        # slot: flushes the write queued there has failed in
+        self._attempts = {}
+        self._oldest = None
+        self._flushes = 0
+        self._writing = False
+        self._closed = False
+        self._cond = threading.Condition()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='eig_state_write_behind')
+        self._thread.start()
+
+    def put(self, write):
+        write = write.snapshot()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError("Can't queue writes on a closed WriteBehindQueue")
+            if write.conditional and getattr(write.owner, '_stale', False):
+                # made before its owner learnt of a conflict, it will be
+                # redone by the owner's next save
+                return
+            older = self._pending.pop(write.slot, None)
+            if older is not None:
+                write.coalesce(older)
+            self._queue(write)
+            if (len(self._pending) == 1 or
+                    len(self._pending) >= self.flush_size):
+                self._cond.notify_all()
+
+    def _queue(self, write):
+        self._pending[write.slot] = write
+        if self._oldest is None:
+            self._oldest = time.monotonic()
+
+    def __len__(self):
+        with self._cond:
+            return len(self._pending)
+
+    def flush(self, timeout=None):
+        """
+        Blocks until every item queued so far has been written, or timeout
+        seconds have passed. Returns whether the queue was drained.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            self._flushes += 1
+            self._cond.notify_all()
+            try:
+                while self._pending or self._writing:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            return False
+                    self._cond.wait(remaining)
+                return True
+            finally:
+                self._flushes -= 1
+
+    def close(self, timeout=None):
+        """
+        Writes everything that is queued and stops the flusher. Returns
+        whether everything was written within timeout seconds.
+        """
+        drained = self.flush(timeout)
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._thread.join(timeout)
+        return drained
+
+    def _due(self):
+        if not self._pending:
+            return False
+        return (self._flushes or self._closed or
+                len(self._pending) >= self.flush_size or
+                time.monotonic() - self._oldest >= self.flush_interval)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._due():
+                    if self._closed:
+                        return
+                    timeout = None
+                    if self._pending:
+                        timeout = max(0, self._oldest + self.flush_interval -
+                                      time.monotonic())
+                    self._cond.wait(timeout)
+                items, self._pending = self._pending, collections.OrderedDict()
+                self._oldest = None
+                self._writing = True
+            slots = list(items)
+            failed, conflicts = self._write(items)
+            with self._cond:
+                for slot in slots:
+                    if slot not in failed:
+                        self._attempts.pop(slot, None)
+                for slot, write in failed.items():
+                    attempts = self._attempts.get(slot, 0) + 1
+                    if attempts >= self.max_attempts:
+                        self._drop(write, attempts)
+                        continue
+                    self._attempts[slot] = attempts
+                    newer = self._pending.get(write.slot)
+                    if newer is None:
+                        self._queue(write)
+                    else:
+                        newer.coalesce(write)
+                for write in conflicts:
+                    self._pending.pop(write.slot, None)
+                    if write.owner is not None:
+                        write.owner.mark_stale()
+                self._writing = False
+                self._cond.notify_all()
+            if failed:
+                time.sleep(self.flush_interval)
+
+    def _drop(self, write, attempts):
+        self._attempts.pop(write.slot, None)
+        logger.error("Dropping the write of %s to %s after %d failed flushes",
+                     write.item['id'], write.table.name, attempts)
+        self.dead_letters.append(write)
+        if write.owner is not None:
+            write.owner.mark_stale()
+
+    def _write(self, items):
+        batch = WriteBatch(self.max_retries, self.backoff,
+                           resolve_conflicts=False)
+        batch.items = items
+        try:
+            batch.flush()
+        except Exception as e:
+            logger.warning("Write behind flush failed, requeueing %d items: %s",
+                           len(items), e)
+            return items, batch.conflicts
+        return {}, batch.conflicts
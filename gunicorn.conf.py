@@ -0,0 +1,24 @@
+# gunicorn -c gunicorn.conf.py 'app:create_app()' serves the WSGI app from
+# threaded workers; with EIG_STATE_WORKER_CLASS=uvicorn.workers.UvicornWorker
+# serve 'app:create_asgi_app()' instead.
+#
+# Each worker process keeps its own sessions and cached histories, and a
+# turn's next_round and set_response must reach the same one, so a single
+# worker serves from its threads by default. Only run more workers
+# (EIG_STATE_WORKERS) behind a router that sends a session to the same
+# worker every time, e.g. one sharding sessions by EIG_STATE_NODE.
+import os
+
+bind = os.environ.get('EIG_STATE_BIND', '0.0.0.0:8080')
+workers = int(os.environ.get('EIG_STATE_WORKERS', 1))
+threads = int(os.environ.get('EIG_STATE_THREADS', 8))
+worker_class = os.environ.get('EIG_STATE_WORKER_CLASS', 'gthread')
+graceful_timeout = int(os.environ.get('EIG_STATE_DRAIN_TIMEOUT', 30))
+
+
+def worker_exit(server, worker):
+    # WSGI workers drain their pending writes here, ASGI ones on lifespan
+    # shutdown
+    config = getattr(worker.wsgi, 'config', None)
+    if config is not None and 'MANAGER_POOL' in config:
+        config['MANAGER_POOL'].close(graceful_timeout)